@@ -1,13 +1,31 @@
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import signal
+import sys
 import os
 import logging
+import asyncio
 import threading
 import re # Importa para usar expressões regulares
-from googleapiclient.discovery import build # Importa para Google Custom Search API
+import itertools
+import hashlib
+import sqlite3
+import bisect
+import contextvars
+import random
+import unicodedata
+import time
+import atexit
+import datetime
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import psycopg2 # <-- NOVO: Importa para PostgreSQL
 from psycopg2 import extras # <-- NOVO: Para funcionalidades extras do psycopg2, embora não usemos execute_values aqui, é boa prática
+from psycopg2 import pool as pg_pool_lib # PoolError, levantado quando não há conexão livre no prazo
+from psycopg2 import sql # Montagem segura de identificadores (nome da coluna de alteração)
 
 # Configuração de logs
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,8 +46,16 @@ PG_DB_PASSWORD = os.environ.get("PG_DB_PASSWORD")
 PG_DB_HOST = os.environ.get("PG_DB_HOST")
 PG_DB_PORT = os.environ.get("PG_DB_PORT", "5432") 
 PG_DB_NAME = os.environ.get("PG_DB_NAME")
+PG_SSLMODE = os.environ.get("PG_SSLMODE", "require") # Neon.tech geralmente exige SSL
 # --- FIM NOVO ---
 
+# --- Pool de conexões PostgreSQL ---
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "5"))
+PG_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("PG_POOL_ACQUIRE_TIMEOUT", "5")) # segundos esperando uma conexão livre
+PG_POOL_IDLE_CHECK = float(os.environ.get("PG_POOL_IDLE_CHECK", "30")) # conexões ociosas há mais tempo que isso são validadas com SELECT 1
+PG_POOL_MAX_LIFETIME = float(os.environ.get("PG_POOL_MAX_LIFETIME", "1800")) # recicla conexões antigas (o Neon suspende computes ociosos)
+
 # --- VERIFICAÇÕES DE VARIÁVEIS DE AMBIENTE ---
 if not OPENROUTER_KEY:
     logging.error("❌ OPENROUTER_KEY não definida. Defina como variável de ambiente para que o app funcione.")
@@ -52,65 +78,675 @@ if not all([PG_DB_USER, PG_DB_PASSWORD, PG_DB_HOST, PG_DB_NAME]):
 
 # --- FUNÇÕES AUXILIARES ---
 
-# NOVO: Função para consultar produtos diretamente do PostgreSQL
-def get_products_from_pg(product_code=None, search_term=None):
-    pg_conn = None
-    pg_cursor = None
+# Conexão com os metadados do pool no próprio objeto (um id() pode ser reaproveitado por outra conexão)
+class _ConexaoPG(psycopg2.extensions.connection):
+    criada_em = 0.0
+    ultimo_uso = 0.0
+
+
+# Pool de conexões compartilhado pelo processo. Evita um handshake TCP+TLS com o Neon
+# a cada mensagem e limita o número de conexões abertas mesmo em rajadas de webhooks.
+# As conexões ociosas ficam numa pilha (LIFO): a mais recente é reutilizada primeiro e as que
+# sobraram de uma rajada envelhecem no fundo, onde são fechadas até restarem `minconn`.
+class PoolConexoesPG:
+    def __init__(self, minconn, maxconn, acquire_timeout, idle_check, max_lifetime, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.idle_check = idle_check
+        self.max_lifetime = max_lifetime
+        self._conn_kwargs = conn_kwargs
+        self._lock = threading.Lock()
+        self._vagas = threading.BoundedSemaphore(maxconn) # conexões em uso + abrindo nunca passam de maxconn
+        self._ociosas = [] # pilha de conexões livres; o topo é a usada mais recentemente
+        self._metricas = {
+            "aquisicoes": 0,
+            "timeouts": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+            "conexoes_criadas": 0,
+            "conexoes_recicladas": 0,
+            "falhas_health_check": 0,
+            "em_uso": 0,
+        }
+
+    def _nova_conexao(self):
+        # Criada sob demanda: não conecta no import (nem antes do fork do servidor)
+        conn = psycopg2.connect(connection_factory=_ConexaoPG, **self._conn_kwargs)
+        conn.autocommit = True # Apenas leituras: sem transações penduradas entre usos
+        conn.criada_em = conn.ultimo_uso = time.monotonic()
+        with self._lock:
+            self._metricas["conexoes_criadas"] += 1
+        return conn
+
+    def _descartar(self, conn):
+        with self._lock:
+            self._metricas["conexoes_recicladas"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _conexao_saudavel(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"⚠️ Conexão PostgreSQL ociosa falhou no health check, reciclando: {e}")
+            with self._lock:
+                self._metricas["falhas_health_check"] += 1
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn = self._ociosas.pop() if self._ociosas else None
+            if conn is None:
+                return self._nova_conexao()
+            agora = time.monotonic()
+            if conn.closed or agora - conn.criada_em > self.max_lifetime:
+                self._descartar(conn)
+            elif agora - conn.ultimo_uso > self.idle_check and not self._conexao_saudavel(conn):
+                self._descartar(conn)
+            else:
+                return conn
+
+    @contextmanager
+    def conexao(self):
+        inicio = time.monotonic()
+        if not self._vagas.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self._metricas["timeouts"] += 1
+            raise pg_pool_lib.PoolError(f"Tempo esgotado ({self.acquire_timeout}s) aguardando conexão livre no pool PostgreSQL.")
+        conn = None
+        try:
+            conn = self._checkout()
+            espera = time.monotonic() - inicio
+            with self._lock:
+                self._metricas["aquisicoes"] += 1
+                self._metricas["espera_total_s"] += espera
+                self._metricas["espera_max_s"] = max(self._metricas["espera_max_s"], espera)
+                self._metricas["em_uso"] += 1
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    self._metricas["em_uso"] -= 1
+                self._devolver(conn)
+        finally:
+            self._vagas.release()
+
+    def _devolver(self, conn):
+        if conn.closed:
+            self._descartar(conn)
+            return
+        try:
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except psycopg2.Error:
+            self._descartar(conn)
+            return
+        agora = time.monotonic()
+        conn.ultimo_uso = agora
+        excedentes = []
+        with self._lock:
+            self._ociosas.append(conn)
+            # Sobras de uma rajada: além de `minconn`, as ociosas há mais de `idle_check` são fechadas
+            while len(self._ociosas) > self.minconn and agora - self._ociosas[0].ultimo_uso > self.idle_check:
+                excedentes.append(self._ociosas.pop(0))
+        for antiga in excedentes:
+            self._descartar(antiga)
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+            dados["ociosas"] = len(self._ociosas)
+        dados["espera_media_s"] = dados["espera_total_s"] / dados["aquisicoes"] if dados["aquisicoes"] else 0.0
+        dados["max"] = self.maxconn
+        return dados
+
+    def fechar(self):
+        with self._lock:
+            ociosas, self._ociosas = self._ociosas, []
+        for conn in ociosas:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+pg_pool = PoolConexoesPG(
+    PG_POOL_MIN,
+    PG_POOL_MAX,
+    acquire_timeout=PG_POOL_ACQUIRE_TIMEOUT,
+    idle_check=PG_POOL_IDLE_CHECK,
+    max_lifetime=PG_POOL_MAX_LIFETIME,
+    host=PG_DB_HOST,
+    database=PG_DB_NAME,
+    user=PG_DB_USER,
+    password=PG_DB_PASSWORD,
+    port=PG_DB_PORT,
+    sslmode=PG_SSLMODE,
+    connect_timeout=10,
+)
+atexit.register(pg_pool.fechar)
+
+# NOVO: Função para consultar produtos diretamente do PostgreSQL (usando conexões do pool)
+def get_products_from_pg(product_code=None, search_term=None, product_codes=None):
     try:
-        pg_conn = psycopg2.connect(
-            host=PG_DB_HOST,
-            database=PG_DB_NAME,
-            user=PG_DB_USER,
-            password=PG_DB_PASSWORD,
-            port=PG_DB_PORT,
-            sslmode='require' # Neon.tech geralmente exige SSL
-        )
-        pg_cursor = pg_conn.cursor()
+        with pg_pool.conexao() as pg_conn, pg_conn.cursor() as pg_cursor:
+            query = "SELECT pro_in_codigo, pro_st_descricao, re_custo FROM produtos"
+            params = []
+
+            if product_code:
+                query += " WHERE UPPER(pro_in_codigo) = %s"
+                params.append(product_code.upper())
+                logging.info(f"DB Query: Buscando produto pelo código: {product_code}")
+            elif product_codes:
+                query += " WHERE UPPER(pro_in_codigo) = ANY(%s)" # vários códigos numa ida só ao banco
+                params.append([codigo.upper() for codigo in product_codes])
+                logging.info(f"DB Query: Buscando produtos pelos códigos: {', '.join(product_codes)}")
+            elif search_term:
+                query += " WHERE LOWER(pro_st_descricao) LIKE %s" 
+                params.append(f"%{search_term.lower()}%")
+                logging.info(f"DB Query: Buscando produtos por termo: {search_term}")
+                query += " LIMIT 50" # Limita a 50 resultados para evitar sobrecarga da resposta da IA
+
+            with medir_etapa("postgres"):
+                pg_cursor.execute(query, params)
+
+                columns = [desc[0] for desc in pg_cursor.description]
+                rows = []
+                for row_data in pg_cursor.fetchall():
+                    rows.append(dict(zip(columns, row_data)))
 
-        query = "SELECT pro_in_codigo, pro_st_descricao, re_custo FROM produtos"
-        params = []
-        
-        if product_code:
-            query += " WHERE UPPER(pro_in_codigo) = %s"
-            params.append(product_code.upper())
-            logging.info(f"DB Query: Buscando produto pelo código: {product_code}")
-        elif search_term:
-            query += " WHERE LOWER(pro_st_descricao) LIKE %s" 
-            params.append(f"%{search_term.lower()}%")
-            logging.info(f"DB Query: Buscando produtos por termo: {search_term}")
-            query += " LIMIT 50" # Limita a 50 resultados para evitar sobrecarga da resposta da IA
-        
-        pg_cursor.execute(query, params)
-        
-        columns = [desc[0] for desc in pg_cursor.description]
-        rows = []
-        for row_data in pg_cursor.fetchall():
-            rows.append(dict(zip(columns, row_data)))
-        
         logging.info(f"DB Query retornou {len(rows)} linhas.")
         return rows
     except psycopg2.Error as e:
         logging.error(f"❌ Erro ao consultar PostgreSQL DB diretamente: {e}", exc_info=True)
         return []
+
+# --- Catálogo de produtos em memória ---
+# A tabela `produtos` é pequena e muda pouco: mantemos uma cópia no processo com um índice
+# invertido de tokens e de trigramas, para que a maioria das buscas nem chegue ao banco.
+def normalizar_texto(texto):
+    # Minúsculas e sem acentos: "Maçã" e "maca" viram a mesma coisa
+    decomposto = unicodedata.normalize("NFKD", str(texto or ""))
+    return "".join(c for c in decomposto if not unicodedata.combining(c)).casefold()
+
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+# Palavras que aparecem nas perguntas mas não descrevem aroma nenhum
+PALAVRAS_IGNORADAS_BUSCA = {
+    "com", "tem", "que", "uma", "umas", "uns", "para", "pra", "por", "sem", "mais", "menos", "qual", "quais",
+    "voce", "voces", "algum", "alguma", "alguns", "algumas", "quero", "queria", "gostaria", "preciso",
+    "fragrancia", "fragrancias", "produto", "produtos", "cheiro", "cheirinho", "contem", "nota", "notas",
+    "olfativa", "olfativas", "aroma", "aromas", "essencia", "essencias", "tipo", "tenha", "tenham", "dos", "das",
+}
+
+
+class CatalogoProdutos:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._produtos = {} # CÓDIGO -> linha da tabela
+        self._descricoes = {} # CÓDIGO -> descrição normalizada
+        self._tokens = {} # token -> {códigos}
+        self._trigramas = {} # trigrama -> {códigos}
+        self.carregado = False
+        self.carregado_em = None
+
+    @staticmethod
+    def _indexar(codigo, descricao, tokens, trigramas):
+        for token in set(re.findall(r"\w+", descricao)):
+            tokens.setdefault(token, set()).add(codigo)
+        for tri in _trigramas(descricao):
+            trigramas.setdefault(tri, set()).add(codigo)
+
+    def carregar(self, linhas):
+        # Monta os índices fora do lock e troca tudo de uma vez
+        produtos, descricoes, tokens, trigramas = {}, {}, {}, {}
+        for linha in linhas:
+            codigo = str(linha.get("pro_in_codigo", "")).upper()
+            if not codigo:
+                continue
+            descricao = normalizar_texto(linha.get("pro_st_descricao"))
+            produtos[codigo] = dict(linha)
+            descricoes[codigo] = descricao
+            self._indexar(codigo, descricao, tokens, trigramas)
+        with self._lock:
+            self._produtos, self._descricoes = produtos, descricoes
+            self._tokens, self._trigramas = tokens, trigramas
+            self.carregado = True
+            self.carregado_em = time.time()
+        logging.info(f"📚 Catálogo de produtos carregado em memória: {len(produtos)} produtos.")
+
+    def aplicar_alteracoes(self, linhas):
+        # Atualiza só as linhas alteradas; o lock garante que as buscas vejam o lote inteiro ou nada dele
+        with self._lock:
+            for linha in linhas:
+                codigo = str(linha.get("pro_in_codigo", "")).upper()
+                if not codigo:
+                    continue
+                antiga = self._descricoes.get(codigo)
+                if antiga is not None:
+                    for token in set(re.findall(r"\w+", antiga)):
+                        self._remover_postagem(self._tokens, token, codigo)
+                    for tri in _trigramas(antiga):
+                        self._remover_postagem(self._trigramas, tri, codigo)
+                descricao = normalizar_texto(linha.get("pro_st_descricao"))
+                self._produtos[codigo] = dict(linha)
+                self._descricoes[codigo] = descricao
+                self._indexar(codigo, descricao, self._tokens, self._trigramas)
+
+    @staticmethod
+    def _remover_postagem(indice, chave, codigo):
+        codigos = indice.get(chave)
+        if codigos is not None:
+            codigos.discard(codigo)
+            if not codigos:
+                del indice[chave]
+
+    def __len__(self):
+        return len(self._produtos)
+
+    def por_codigo(self, codigo):
+        with self._lock:
+            linha = self._produtos.get(str(codigo).upper())
+            return dict(linha) if linha else None
+
+    def por_codigos(self, codigos):
+        # Retorna (produtos encontrados, códigos que não estão no catálogo)
+        produtos, faltando = [], []
+        with self._lock:
+            for codigo in codigos:
+                linha = self._produtos.get(str(codigo).upper())
+                if linha:
+                    produtos.append(dict(linha))
+                else:
+                    faltando.append(codigo)
+        return produtos, faltando
+
+    def _codigos_contendo(self, termo):
+        # Chamado com o lock adquirido. Usa os trigramas para reduzir os candidatos e confirma com `in`.
+        if len(termo) >= 3:
+            candidatos = None
+            for tri in _trigramas(termo):
+                codigos = self._trigramas.get(tri)
+                if not codigos:
+                    return set()
+                candidatos = set(codigos) if candidatos is None else candidatos & codigos
+        else:
+            candidatos = self._descricoes.keys()
+        return {c for c in candidatos if termo in self._descricoes[c]}
+
+    def buscar_substring(self, termo, limite=50):
+        # Equivalente ao `LOWER(pro_st_descricao) LIKE '%termo%'`, mas ignorando acentos
+        termo = normalizar_texto(termo).strip()
+        if not termo:
+            return []
+        with self._lock:
+            codigos = sorted(self._codigos_contendo(termo))[:limite]
+            return [dict(self._produtos[c]) for c in codigos]
+
+    def buscar_notas(self, palavras, limite=5):
+        # Ranqueia por quantas notas olfativas a descrição cobre; palavra inteira vale mais que pedaço
+        termos = []
+        for palavra in palavras:
+            termo = normalizar_texto(palavra).strip(" .,;:!?()\"'")
+            if len(termo) > 2 and termo not in PALAVRAS_IGNORADAS_BUSCA and termo not in termos:
+                termos.append(termo)
+        if not termos:
+            return []
+        with self._lock:
+            pontuacao = {}
+            for termo in termos:
+                exatos = self._tokens.get(termo, set())
+                for codigo in self._codigos_contendo(termo):
+                    cobertos, pontos = pontuacao.get(codigo, (0, 0))
+                    pontuacao[codigo] = (cobertos + 1, pontos + (2 if codigo in exatos else 1))
+            ranking = sorted(
+                pontuacao.items(),
+                key=lambda item: (-item[1][0], -item[1][1], len(self._descricoes[item[0]]), item[0]),
+            )
+            return [dict(self._produtos[codigo]) for codigo, _ in ranking[:limite]]
+
+
+CATALOGO_ATIVO = os.environ.get("CATALOGO_ATIVO", "1") == "1"
+CATALOGO_INTERVALO_SYNC = float(os.environ.get("CATALOGO_INTERVALO_SYNC", "30")) # segundos entre sincronizações incrementais
+CATALOGO_TTL = float(os.environ.get("CATALOGO_TTL", "3600")) # segundos entre recargas completas (também cobre exclusões)
+CATALOGO_COLUNA_ALTERACAO = os.environ.get("CATALOGO_COLUNA_ALTERACAO", "updated_at") # coluna timestamp usada como marca d'água
+
+catalogo = CatalogoProdutos()
+
+
+# Mantém o catálogo atualizado em segundo plano: a cada ciclo busca apenas as linhas com
+# `updated_at` (ou a coluna configurada) maior ou igual à última marca d'água vista.
+# Se a coluna não existir na tabela, faz recargas completas a cada CATALOGO_TTL.
+class AtualizadorCatalogo:
+    # Marca usada quando a recarga não achou nenhum valor na coluna (tabela vazia ou tudo NULL):
+    # o Postgres converte '-infinity' para o tipo da coluna, então a próxima sincronização pega qualquer valor
+    MARCA_INICIAL = "-infinity"
+
+    def __init__(self, catalogo, intervalo_sync, intervalo_recarga, coluna_alteracao):
+        self.catalogo = catalogo
+        self.intervalo_sync = intervalo_sync
+        self.intervalo_recarga = intervalo_recarga
+        self.coluna_alteracao = coluna_alteracao
+        self._usa_marca = None # descoberto na primeira recarga
+        self._marca_dagua = None
+        self._ultima_recarga = 0.0
+        self._lock = threading.Lock()
+        self._metricas = {
+            "ultima_sincronizacao": None,
+            "recargas_completas": 0,
+            "sincronizacoes_incrementais": 0,
+            "linhas_aplicadas": 0,
+            "falhas": 0,
+        }
+
+    def _colunas_consulta(self):
+        colunas = sql.SQL("pro_in_codigo, pro_st_descricao, re_custo")
+        if self._usa_marca:
+            colunas = sql.SQL("{}, {}").format(colunas, sql.Identifier(self.coluna_alteracao))
+        return colunas
+
+    def _coluna_existe(self, pg_cursor):
+        pg_cursor.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'produtos' AND column_name = %s",
+            [self.coluna_alteracao],
+        )
+        return pg_cursor.fetchone() is not None
+
+    def _consultar(self, pg_cursor, query, params=None):
+        pg_cursor.execute(query, params)
+        columns = [desc[0] for desc in pg_cursor.description]
+        linhas = [dict(zip(columns, row_data)) for row_data in pg_cursor.fetchall()]
+        if self._usa_marca:
+            for linha in linhas:
+                alterado_em = linha.pop(self.coluna_alteracao, None)
+                sem_marca = self._marca_dagua is None or self._marca_dagua == self.MARCA_INICIAL
+                if alterado_em is not None and (sem_marca or alterado_em > self._marca_dagua):
+                    self._marca_dagua = alterado_em
+        return linhas
+
+    def recarregar(self):
+        with pg_pool.conexao() as pg_conn, pg_conn.cursor() as pg_cursor:
+            if self._usa_marca is None:
+                self._usa_marca = self._coluna_existe(pg_cursor)
+                if not self._usa_marca:
+                    logging.warning(f"⚠️ Coluna '{self.coluna_alteracao}' não existe em produtos; o catálogo será atualizado só por recargas completas.")
+            self._marca_dagua = None
+            query = sql.SQL("SELECT {} FROM produtos").format(self._colunas_consulta())
+            linhas = self._consultar(pg_cursor, query)
+        if self._usa_marca and self._marca_dagua is None:
+            self._marca_dagua = self.MARCA_INICIAL
+        self.catalogo.carregar(linhas)
+        self._ultima_recarga = time.monotonic()
+        with self._lock:
+            self._metricas["recargas_completas"] += 1
+            self._metricas["linhas_aplicadas"] += len(linhas)
+            self._metricas["ultima_sincronizacao"] = time.time()
+
+    def sincronizar(self):
+        with pg_pool.conexao() as pg_conn, pg_conn.cursor() as pg_cursor:
+            query = sql.SQL("SELECT {} FROM produtos WHERE {} >= %s").format(
+                self._colunas_consulta(), sql.Identifier(self.coluna_alteracao)
+            )
+            # `>=` para não perder linhas gravadas com o mesmo timestamp da marca; reaplicar é inofensivo
+            linhas = self._consultar(pg_cursor, query, [self._marca_dagua])
+        self.catalogo.aplicar_alteracoes(linhas)
+        with self._lock:
+            self._metricas["sincronizacoes_incrementais"] += 1
+            self._metricas["linhas_aplicadas"] += len(linhas)
+            self._metricas["ultima_sincronizacao"] = time.time()
+        if linhas:
+            logging.info(f"🔄 Catálogo sincronizado: {len(linhas)} produtos alterados.")
+
+    def executar_ciclo(self):
+        try:
+            recarga_vencida = time.monotonic() - self._ultima_recarga >= self.intervalo_recarga
+            if not self.catalogo.carregado or recarga_vencida or (self._usa_marca and self._marca_dagua is None):
+                self.recarregar()
+            elif self._usa_marca:
+                self.sincronizar()
+        except psycopg2.Error as e:
+            with self._lock:
+                self._metricas["falhas"] += 1
+            logging.error(f"❌ Erro ao sincronizar o catálogo de produtos: {e}", exc_info=True)
+
+    def _loop(self):
+        while True:
+            self.executar_ciclo()
+            time.sleep(self.intervalo_sync)
+
+    def iniciar(self):
+        threading.Thread(target=self._loop, name="catalogo-produtos", daemon=True).start()
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+        ultima = dados["ultima_sincronizacao"]
+        dados["defasagem_s"] = time.time() - ultima if ultima else None
+        dados["produtos"] = len(self.catalogo)
+        dados["modo"] = "incremental" if self._usa_marca else "recarga_completa"
+        return dados
+
+
+atualizador_catalogo = AtualizadorCatalogo(catalogo, CATALOGO_INTERVALO_SYNC, CATALOGO_TTL, CATALOGO_COLUNA_ALTERACAO)
+
+
+def iniciar_catalogo():
+    if CATALOGO_ATIVO:
+        atualizador_catalogo.iniciar()
+
+
+# Busca produtos no catálogo em memória quando ele está carregado; senão (ou se o código não
+# estiver lá, ex.: produto recém-cadastrado) cai para a consulta no PostgreSQL.
+def buscar_produtos(product_code=None, search_term=None, product_codes=None):
+    if catalogo.carregado:
+        if product_codes:
+            produtos, faltando = catalogo.por_codigos(product_codes)
+            if faltando:
+                # Os que não estão no catálogo vêm todos juntos numa única consulta
+                do_banco = get_products_from_pg(product_codes=faltando)
+                catalogo.aplicar_alteracoes(do_banco)
+                produtos.extend(do_banco)
+            return produtos
+        if product_code:
+            prod = catalogo.por_codigo(product_code)
+            if prod:
+                return [prod]
+            # Produto ainda não sincronizado: consulta o banco e já guarda no catálogo
+            produtos = get_products_from_pg(product_code=product_code)
+            catalogo.aplicar_alteracoes(produtos)
+            return produtos
+        elif search_term:
+            return catalogo.buscar_substring(search_term)
+    return get_products_from_pg(product_code=product_code, search_term=search_term, product_codes=product_codes)
+
+
+def _linha_achado(prod):
+    descricao = (prod.get("pro_st_descricao") or "").lower()
+    return f"Código: {prod.get('pro_in_codigo', '')} - Descrição: {descricao}"
+
+
+def _filtrar_por_notas(produtos, palavras_chave):
+    # Sem catálogo em memória: filtra o resultado do LIKE pelas palavras citadas (até 5 produtos)
+    achados = []
+    for prod in produtos:
+        descricao = (prod.get("pro_st_descricao") or "").lower()
+        if any(termo in descricao for termo in palavras_chave):
+            achados.append(_linha_achado(prod))
+            if len(achados) >= 5:
+                break
+    return achados
+
+
+# Busca fragrâncias pelas notas olfativas citadas; devolve as linhas prontas para o prompt
+def _tem_termo_de_busca(palavras_chave):
+    return any(normalizar_texto(p) not in PALAVRAS_IGNORADAS_BUSCA for p in palavras_chave)
+
+
+def buscar_por_notas(palavras_chave):
+    if not _tem_termo_de_busca(palavras_chave):
+        return [] # só "com", "tem"...: o LIKE varreria a tabela sem achar nada útil
+    if catalogo.carregado:
+        # Busca no catálogo em memória, ranqueando pelas notas olfativas citadas
+        return [_linha_achado(prod) for prod in catalogo.buscar_notas(palavras_chave, limite=5)]
+    return _filtrar_por_notas(get_products_from_pg(search_term=" ".join(palavras_chave)), palavras_chave)
+
+
+# --- Clientes HTTP compartilhados ---
+# Uma sessão `requests` por serviço externo, criada uma vez e reaproveitada por todas as threads:
+# as conexões TLS ficam abertas (keep-alive) em vez de um handshake novo a cada mensagem.
+# As URLs podem ser trocadas por variáveis de ambiente (ex.: servidores falsos do benchmark de carga)
+ULTRAMSG_URL = os.environ.get("ULTRAMSG_URL", "https://api.ultramsg.com/instance126332/messages/chat") # Instância UltraMsg corrigida
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+GOOGLE_CSE_URL = os.environ.get("GOOGLE_CSE_URL", "https://www.googleapis.com/customsearch/v1") # REST da Custom Search
+
+HTTP_POOL_CONEXOES = int(os.environ.get("HTTP_POOL_CONEXOES", "20")) # conexões mantidas por serviço
+HTTP_RETENTATIVAS = int(os.environ.get("HTTP_RETENTATIVAS", "2")) # só para chamadas idempotentes
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.3")) # segundos; dobra a cada tentativa, com jitter
+HTTP_STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+
+
+class HistogramaLatencia:
+    LIMITES = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # segundos
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contagens = [0] * (len(self.LIMITES) + 1) # último balde: acima do maior limite
+        self._soma = 0.0
+        self._total = 0
+
+    def observar(self, segundos):
+        indice = bisect.bisect_left(self.LIMITES, segundos)
+        with self._lock:
+            self._contagens[indice] += 1
+            self._soma += segundos
+            self._total += 1
+
+    def estatisticas(self):
+        with self._lock:
+            contagens, soma, total = list(self._contagens), self._soma, self._total
+        acumulado, baldes = 0, {}
+        for limite, contagem in zip(self.LIMITES + (float("inf"),), contagens):
+            acumulado += contagem
+            baldes[limite] = acumulado
+        return {"baldes": baldes, "soma_s": soma, "total": total}
+
+
+LATENCIAS_UPSTREAM = {
+    "openrouter": HistogramaLatencia(),
+    "ultramsg": HistogramaLatencia(),
+    "google_cse": HistogramaLatencia(),
+}
+
+
+# --- Etapas do processamento e trace amostrado ---
+# Cada etapa de uma mensagem (roteamento, consulta ao Postgres, passos do fluxo, envio) alimenta
+# um histograma, exportado em /metrics. Com TRACE_AMOSTRAGEM > 0, uma fração das mensagens também
+# ganha uma linha de log com a duração de cada etapa, na ordem em que terminaram.
+TRACE_AMOSTRAGEM = float(os.environ.get("TRACE_AMOSTRAGEM", "0")) # fração das mensagens (0 a 1)
+
+LATENCIAS_ETAPAS = {
+    etapa: HistogramaLatencia()
+    for etapa in ("roteamento", "produtos", "notas", "postgres", "web", "ia", "envio", "total")
+}
+
+# contextvars funciona tanto nas threads quanto nas corrotinas do modo async
+_rastro_atual = contextvars.ContextVar("rastro_atual", default=None)
+
+
+@contextmanager
+def medir_etapa(etapa):
+    inicio = time.monotonic()
+    try:
+        yield
     finally:
-        if pg_cursor: pg_cursor.close()
-        if pg_conn: pg_conn.close()
+        duracao = time.monotonic() - inicio
+        LATENCIAS_ETAPAS[etapa].observar(duracao)
+        rastro = _rastro_atual.get()
+        if rastro is not None:
+            rastro.append((etapa, duracao))
+
+
+@contextmanager
+def rastrear_mensagem(numero):
+    if TRACE_AMOSTRAGEM <= 0 or random.random() >= TRACE_AMOSTRAGEM:
+        yield
+        return
+    rastro = []
+    token = _rastro_atual.set(rastro)
+    try:
+        yield
+    finally:
+        _rastro_atual.reset(token)
+        etapas = " ".join(f"{etapa}={duracao * 1000:.1f}ms" for etapa, duracao in rastro)
+        logging.info(f"🧵 Trace da mensagem de {numero}: {etapas}")
+
+
+def _criar_sessao_http():
+    sessao = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_CONEXOES)
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
+
+SESSOES_HTTP = {upstream: _criar_sessao_http() for upstream in LATENCIAS_UPSTREAM}
+
+
+def _pausa_backoff(tentativa):
+    # "Full jitter": espera aleatória entre 0 e base * 2^tentativa, para as retentativas não se alinharem
+    return random.uniform(0, HTTP_BACKOFF_BASE * (2 ** tentativa))
+
+
+# Faz a requisição pela sessão do serviço, medindo a latência de cada tentativa.
+# Chamadas idempotentes são repetidas em falhas de rede e em 429/5xx; as demais (ex.: envio
+# de mensagem, geração na IA) são feitas uma vez só para não duplicar efeitos.
+def requisicao_http(upstream, metodo, url, idempotente=False, **kwargs):
+    tentativas = 1 + (HTTP_RETENTATIVAS if idempotente else 0)
+    for tentativa in range(tentativas):
+        ultima = tentativa == tentativas - 1
+        inicio = time.monotonic()
+        try:
+            resp = SESSOES_HTTP[upstream].request(metodo, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            LATENCIAS_UPSTREAM[upstream].observar(time.monotonic() - inicio)
+            if ultima:
+                raise
+            logging.warning(f"⚠️ Falha de rede com {upstream} (tentativa {tentativa + 1}/{tentativas}): {e}")
+        else:
+            LATENCIAS_UPSTREAM[upstream].observar(time.monotonic() - inicio)
+            if ultima or resp.status_code not in HTTP_STATUS_RETENTAVEIS:
+                return resp
+            logging.warning(f"⚠️ {upstream} respondeu {resp.status_code} (tentativa {tentativa + 1}/{tentativas}).")
+        time.sleep(_pausa_backoff(tentativa))
+
+
+# Transforma a resposta da Custom Search API nas linhas usadas no prompt da IA
+def _extrair_snippets(res):
+    snippets = []
+    if 'items' in res:
+        for item in res['items']:
+            if 'snippet' in item:
+                title = item.get('title', 'Título indisponível')
+                link = item.get('link', 'Link indisponível')
+                snippet_text = item['snippet']
+                snippets.append(f"- {title}: {snippet_text} (Fonte: {link})")
+    return snippets
 
 # Função para realizar a pesquisa web com Google Custom Search
 def perform_google_custom_search(query):
     try:
-        service = build("customsearch", "v1", developerKey=SEARCH_API_KEY)
-        res = service.cse().list(q=query, cx=SEARCH_CX, num=3).execute() 
-        
-        snippets = []
-        if 'items' in res:
-            for item in res['items']:
-                if 'snippet' in item:
-                    title = item.get('title', 'Título indisponível')
-                    link = item.get('link', 'Link indisponível')
-                    snippet_text = item['snippet']
-                    snippets.append(f"- {title}: {snippet_text} (Fonte: {link})")
-        return snippets
+        params = {"key": SEARCH_API_KEY, "cx": SEARCH_CX, "q": query, "num": 3}
+        resp = requisicao_http("google_cse", "GET", GOOGLE_CSE_URL, idempotente=True, params=params, timeout=10)
+        resp.raise_for_status()
+        return _extrair_snippets(resp.json())
     except Exception as e:
         logging.error(f"❌ Erro ao realizar pesquisa com Google Custom Search API: {e}", exc_info=True)
         return []
@@ -118,8 +754,10 @@ def perform_google_custom_search(query):
 # Função para enviar resposta via UltraMsg
 def enviar_resposta_ultramsg(numero, body):
     try:
-        resp = requests.post(
-            "https://api.ultramsg.com/instance126332/messages/chat", # Instância UltraMsg corrigida
+        resp = requisicao_http(
+            "ultramsg",
+            "POST",
+            ULTRAMSG_URL,
             data={
                 "token": ULTRAMSG_TOKEN,
                 "to": numero,
@@ -129,21 +767,14 @@ def enviar_resposta_ultramsg(numero, body):
         )
         resp.raise_for_status()
         logging.info(f"✅ Resposta enviada para {numero}. UltraMsg retornou: {resp.text}")
+        return True
     except requests.exceptions.RequestException as e:
         logging.error(f"❌ Erro ao enviar resposta via UltraMsg para {numero}: {e}", exc_info=True)
+        return False
 
-# Função para responder via IA (OpenRouter)
-def responder_ia(prompt):
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "model": "google/gemini-2.0-flash-001", 
-        "messages": [
-            {
-                "role": "system",
-                "content": """🎉 Olá! Eu sou a Iris, a assistente virtual da Ginger Fragrances! ✨ Meu papel é ser sua melhor amiga no mundo dos aromas: sempre educada, prestativa, simpática e com um toque de criatividade! 💖 Fui criada para ajudar nossos incríveis vendedores e funcionários a encontrar rapidinho os códigos das fragrâncias com base nas notas olfativas que os clientes amam, tipo maçã 🍎, bambu 🎋, baunilha 🍦 e muito mais! 
+MODELO_IA = "google/gemini-2.0-flash-001"
+
+PROMPT_SISTEMA_IRIS = """🎉 Olá! Eu sou a Iris, a assistente virtual da Ginger Fragrances! ✨ Meu papel é ser sua melhor amiga no mundo dos aromas: sempre educada, prestativa, simpática e com um toque de criatividade! 💖 Fui criada para ajudar nossos incríveis vendedores e funcionários a encontrar rapidinho os códigos das fragrâncias com base nas notas olfativas que os clientes amam, tipo maçã 🍎, bambu 🎋, baunilha 🍦 e muito mais! 
                 Além disso, eu posso **realizar pesquisas na web para te ajudar com perguntas mais gerais**, **informar o custo de uma fragrância específica pelo código OU nome** e, se você precisar, posso **calcular o preço de venda das nossas fragrâncias** com o markup que você me disser!
                 
                 **Nossos Valores na Ginger Fragrances são:**
@@ -152,41 +783,538 @@ def responder_ia(prompt):
                 * **RESPEITO ÀS PESSOAS E AO MEIO AMBIENTE**
                 
                 Sempre que alguém descrever um cheirinho ou uma sensação, minha missão é indicar as fragrâncias que mais se aproximam disso, **listando os códigos correspondentes de forma clara, única, rápida e super eficiente, e sendo o mais concisa possível na resposta. Responda apenas uma vez.** Vamos descobrir o aroma perfeito? 😊"""
-            },
+
+# Respostas de contingência quando a IA falha (compartilhadas pelos modos thread e async)
+RESPOSTA_IA_VAZIA = "Ops! 🤷‍♀️ Não consegui gerar uma resposta agora! Parece que a magia dos aromas está um pouquinho distante. Tente de novo! 😉"
+RESPOSTA_IA_INDISPONIVEL = "Ah, não! 😩 Estou com um pequeno probleminha pra falar com o universo da inteligência artificial agora. Por favor, me dê um minutinho e tente de novo mais tarde! Prometo caprichar na próxima! ✨"
+RESPOSTA_IA_INVALIDA = "Eita! 😲 Recebi uma resposta estranha do meu cérebro virtual! Será que a internet deu uma embolada? Tenta mais uma vez, por favor! 🙏"
+RESPOSTA_IA_ERRO = "Puxa! 😱 Aconteceu um erro inesperado enquanto eu estava pensando na sua resposta! Mas calma, já estou avisando os gênios da Ginger Fragrances pra eles darem um jeitinho! Me manda um 'oi' de novo pra gente tentar! 😉"
+
+
+def _montar_requisicao_ia(prompt):
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_KEY}",
+        "Content-Type": "application/json"
+    }
+    body = {
+        "model": MODELO_IA, 
+        "messages": [
+            {"role": "system", "content": PROMPT_SISTEMA_IRIS},
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.3 # Ajustado para um equilíbrio entre criatividade e concisão
     }
+    return headers, body
 
-    try:
-        r = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=body, timeout=30)
-        r.raise_for_status()
-        resposta = r.json()
 
-        if "choices" not in resposta or not resposta['choices']:
-            logging.error(f"❌ Resposta da IA não contém 'choices' ou está vazia: {json.dumps(resposta, indent=2)}")
-            return "Ops! 🤷‍♀️ Não consegui gerar uma resposta agora! Parece que a magia dos aromas está um pouquinho distante. Tente de novo! 😉"
+def _extrair_resposta_ia(resposta):
+    if "choices" not in resposta or not resposta['choices']:
+        logging.error(f"❌ Resposta da IA não contém 'choices' ou está vazia: {json.dumps(resposta, indent=2)}")
+        return RESPOSTA_IA_VAZIA
+    return resposta['choices'][0]['message']['content']
+
+
+# --- Cache de respostas ---
+# LRU com expiração (TTL). O backend em memória serve um processo; o backend em disco (SQLite
+# local em modo WAL) é compartilhado pelos vários workers do gunicorn na mesma máquina.
+class CacheMemoriaTTL:
+    def __init__(self, max_itens, ttl):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._itens = OrderedDict() # chave -> (expira_em, valor), do menos para o mais recente
+        self._metricas = {"acertos": 0, "faltas": 0, "expirados": 0, "removidos": 0}
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[0] < time.monotonic():
+                del self._itens[chave]
+                self._metricas["expirados"] += 1
+                item = None
+            if item is None:
+                self._metricas["faltas"] += 1
+                return None
+            self._itens.move_to_end(chave)
+            self._metricas["acertos"] += 1
+            return item[1]
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (time.monotonic() + self.ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+                self._metricas["removidos"] += 1
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+            dados["itens"] = len(self._itens)
+        consultas = dados["acertos"] + dados["faltas"]
+        dados["taxa_acerto"] = dados["acertos"] / consultas if consultas else 0.0
+        return dados
+
 
-        return resposta['choices'][0]['message']['content']
+class CacheDiscoTTL:
+    def __init__(self, arquivo, max_itens, ttl):
+        self.arquivo = arquivo
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._local = threading.local() # uma conexão SQLite por thread
+        self._lock = threading.Lock()
+        self._metricas = {"acertos": 0, "faltas": 0, "expirados": 0, "removidos": 0}
+        with self._conexao() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (chave TEXT PRIMARY KEY, valor TEXT NOT NULL, expira_em REAL NOT NULL, usado_em REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_usado_em ON cache (usado_em)")
+
+    def _conexao(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.arquivo, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _contar(self, metrica, n=1):
+        with self._lock:
+            self._metricas[metrica] += n
+
+    def obter(self, chave):
+        agora = time.time()
+        try:
+            with self._conexao() as conn:
+                linha = conn.execute("SELECT valor, expira_em FROM cache WHERE chave = ?", (chave,)).fetchone()
+                if linha is not None and linha[1] < agora:
+                    conn.execute("DELETE FROM cache WHERE chave = ?", (chave,))
+                    self._contar("expirados")
+                    linha = None
+                if linha is None:
+                    self._contar("faltas")
+                    return None
+                conn.execute("UPDATE cache SET usado_em = ? WHERE chave = ?", (agora, chave))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Erro ao ler o cache em disco ({self.arquivo}): {e}")
+            self._contar("faltas")
+            return None
+        self._contar("acertos")
+        return json.loads(linha[0])
+
+    def guardar(self, chave, valor):
+        agora = time.time()
+        try:
+            with self._conexao() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (chave, valor, expira_em, usado_em) VALUES (?, ?, ?, ?)",
+                    (chave, json.dumps(valor, ensure_ascii=False), agora + self.ttl, agora),
+                )
+                excedente = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_itens
+                if excedente > 0:
+                    conn.execute("DELETE FROM cache WHERE chave IN (SELECT chave FROM cache ORDER BY usado_em LIMIT ?)", (excedente,))
+                    self._contar("removidos", excedente)
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Erro ao gravar no cache em disco ({self.arquivo}): {e}")
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+        try:
+            dados["itens"] = self._conexao().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        except sqlite3.Error:
+            dados["itens"] = None
+        consultas = dados["acertos"] + dados["faltas"]
+        dados["taxa_acerto"] = dados["acertos"] / consultas if consultas else 0.0
+        return dados
+
+
+def criar_cache(backend, max_itens, ttl, arquivo=None):
+    if backend == "memoria":
+        return CacheMemoriaTTL(max_itens, ttl)
+    if backend == "disco":
+        return CacheDiscoTTL(arquivo, max_itens, ttl)
+    if backend != "desligado":
+        logging.warning(f"⚠️ Backend de cache desconhecido '{backend}'; cache desligado.")
+    return None
+
+
+# Cache das respostas da IA: o mesmo prompt (ex.: "custo da PR11410") não paga outra ida à OpenRouter
+IA_CACHE_BACKEND = os.environ.get("IA_CACHE_BACKEND", "memoria") # "memoria", "disco" ou "desligado"
+IA_CACHE_MAX = int(os.environ.get("IA_CACHE_MAX", "1000"))
+IA_CACHE_TTL = float(os.environ.get("IA_CACHE_TTL", "3600")) # segundos
+IA_CACHE_ARQUIVO = os.environ.get("IA_CACHE_ARQUIVO", "/tmp/iris_cache_ia.sqlite3")
+
+cache_ia = criar_cache(IA_CACHE_BACKEND, IA_CACHE_MAX, IA_CACHE_TTL, IA_CACHE_ARQUIVO)
+
+
+def _chave_cache_ia(body):
+    # Modelo + prompt de sistema + prompt do usuário normalizado (espaços e maiúsculas não contam)
+    prompt_normalizado = " ".join(body["messages"][-1]["content"].split()).casefold()
+    base = "\x1f".join([body["model"], body["messages"][0]["content"], prompt_normalizado])
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+def _guardar_resposta_ia(chave_cache, resposta):
+    # Só respostas de verdade vão para o cache; as mensagens de contingência não
+    if cache_ia is not None and resposta != RESPOSTA_IA_VAZIA:
+        cache_ia.guardar(chave_cache, resposta)
+    return resposta
+
+
+# Função para responder via IA (OpenRouter)
+def responder_ia(prompt):
+    headers, body = _montar_requisicao_ia(prompt)
+    chave_cache = _chave_cache_ia(body)
+    if cache_ia is not None:
+        em_cache = cache_ia.obter(chave_cache)
+        if em_cache is not None:
+            return em_cache
+
+    try:
+        r = requisicao_http("openrouter", "POST", OPENROUTER_URL, headers=headers, json=body, timeout=30)
+        r.raise_for_status()
+        return _guardar_resposta_ia(chave_cache, _extrair_resposta_ia(r.json()))
     except requests.exceptions.RequestException as e:
         logging.error(f"❌ Erro ao comunicar com a API da OpenRouter: {e}", exc_info=True)
-        return "Ah, não! 😩 Estou com um pequeno probleminha pra falar com o universo da inteligência artificial agora. Por favor, me dê um minutinho e tente de novo mais tarde! Prometo caprichar na próxima! ✨"
+        return RESPOSTA_IA_INDISPONIVEL
     except json.JSONDecodeError:
         logging.error(f"❌ Resposta da IA não é um JSON válido. Status: {r.status_code}, Resposta: {r.text}", exc_info=True)
-        return "Eita! 😲 Recebi uma resposta estranha do meu cérebro virtual! Será que a internet deu uma embolada? Tenta mais uma vez, por favor! 🙏"
+        return RESPOSTA_IA_INVALIDA
     except Exception as e:
         logging.error(f"❌ Erro inesperado ao processar resposta da IA: {e}", exc_info=True)
-        return "Puxa! 😱 Aconteceu um erro inesperado enquanto eu estava pensando na sua resposta! Mas calma, já estou avisando os gênios da Ginger Fragrances pra eles darem um jeitinho! Me manda um 'oi' de novo pra gente tentar! 😉"
+        return RESPOSTA_IA_ERRO
 
 
-# Função principal de processamento da mensagem (executada em segundo plano)
-def processar_mensagem_em_segundo_plano(ultramsg_data, numero, msg):
-    logging.info(f"📩 [Processamento em Segundo Plano] Mensagem recebida de {numero}: '{msg}'")
+# --- Pesquisa web com cache e limite de cota ---
+# Perguntas repetidas não gastam cota da Custom Search: o resultado fica em cache pela consulta
+# normalizada (sem acentos, maiúsculas e palavras vazias). Um balde de tokens espalha a cota
+# diária pelas horas de atendimento e um teto diário garante que ela não estoure; sem token, a
+# Iris responde sem dados da web em vez de dar erro.
+BUSCA_CACHE_BACKEND = os.environ.get("BUSCA_CACHE_BACKEND", "memoria") # "memoria", "disco" ou "desligado"
+BUSCA_CACHE_MAX = int(os.environ.get("BUSCA_CACHE_MAX", "2000"))
+BUSCA_CACHE_TTL = float(os.environ.get("BUSCA_CACHE_TTL", str(24 * 3600))) # segundos
+BUSCA_CACHE_ARQUIVO = os.environ.get("BUSCA_CACHE_ARQUIVO", "/tmp/iris_cache_busca.sqlite3")
+CSE_COTA_DIARIA = int(os.environ.get("CSE_COTA_DIARIA", "100")) # consultas/dia da Custom Search (100 no plano gratuito)
+CSE_RAJADA = int(os.environ.get("CSE_RAJADA", "10")) # consultas seguidas permitidas antes de o limite atuar
+CSE_HORAS_ATIVAS = float(os.environ.get("CSE_HORAS_ATIVAS", "8")) # horas de atendimento por dia em que a cota é reposta
+
+# Só artigos, saudações e muletas: negações e preposições que mudam o sentido ("com"/"sem",
+# "para"/"por", "ou", "se") ficam na chave, senão "perfume com álcool" e "perfume sem álcool" colidem
+PALAVRAS_VAZIAS_CONSULTA = {
+    "a", "o", "as", "os", "um", "uma", "uns", "umas", "de", "da", "do", "das", "dos", "em", "na", "no", "nas", "nos",
+    "e", "que", "qual", "quais", "me", "te", "voce", "voces", "eu",
+    "iris", "oi", "ola", "favor", "sobre", "como", "eh", "ai", "la", "sabe", "saber", "dizer", "diz",
+}
+
+
+def normalizar_consulta(consulta):
+    tokens = re.findall(r"\w+", normalizar_texto(consulta))
+    relevantes = [t for t in tokens if t not in PALAVRAS_VAZIAS_CONSULTA]
+    return " ".join(relevantes or tokens)
+
+
+class BaldeTokens:
+    def __init__(self, cota_diaria, rajada, horas_ativas=24):
+        self.cota_diaria = cota_diaria
+        self.capacidade = max(1, min(rajada, cota_diaria))
+        # Repõe a cota nas horas de atendimento, não nas 24 h: com 86400 s e rajada 10, um dia de
+        # 8 h só liberava ~43 das 100 consultas. O teto diário (_usadas_hoje) segura o excesso.
+        self.taxa = cota_diaria / (max(1.0, min(horas_ativas, 24.0)) * 3600) # tokens por segundo
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacidade)
+        self._atualizado = time.monotonic()
+        self._dia = None
+        self._usadas_hoje = 0
+        self._metricas = {"permitidas": 0, "negadas": 0}
+
+    @staticmethod
+    def _hoje():
+        # A cota do Google zera à meia-noite do horário do Pacífico (aproximado como UTC-8)
+        return (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=8)).date()
+
+    def consumir(self):
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.capacidade, self._tokens + (agora - self._atualizado) * self.taxa)
+            self._atualizado = agora
+            hoje = self._hoje()
+            if hoje != self._dia:
+                self._dia, self._usadas_hoje = hoje, 0
+            if self._tokens < 1 or self._usadas_hoje >= self.cota_diaria:
+                self._metricas["negadas"] += 1
+                return False
+            self._tokens -= 1
+            self._usadas_hoje += 1
+            self._metricas["permitidas"] += 1
+            return True
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+            dados["tokens"] = self._tokens
+            dados["cota_restante_hoje"] = self.cota_diaria - self._usadas_hoje if self._dia == self._hoje() else self.cota_diaria
+        return dados
+
+
+cache_busca = criar_cache(BUSCA_CACHE_BACKEND, BUSCA_CACHE_MAX, BUSCA_CACHE_TTL, BUSCA_CACHE_ARQUIVO)
+limite_busca = BaldeTokens(CSE_COTA_DIARIA, CSE_RAJADA, CSE_HORAS_ATIVAS)
+
+
+def _busca_em_cache(chave):
+    return cache_busca.obter(chave) if cache_busca is not None else None
+
+
+def _guardar_busca(chave, snippets):
+    # Só guarda resultados de verdade; lista vazia pode ser erro passageiro
+    if cache_busca is not None and snippets:
+        cache_busca.guardar(chave, snippets)
+    return snippets
+
+
+def _busca_permitida(consulta):
+    if limite_busca.consumir():
+        return True
+    logging.warning(f"⚠️ Limite de cota da Custom Search atingido; respondendo sem pesquisa web para '{consulta}'.")
+    return False
+
+
+def pesquisar_web(consulta):
+    chave = normalizar_consulta(consulta)
+    snippets = _busca_em_cache(chave)
+    if snippets is not None:
+        return snippets
+    if not _busca_permitida(consulta):
+        return []
+    return _guardar_busca(chave, perform_google_custom_search(consulta))
+
+
+# --- Roteador de intenções ---
+# Todas as regras são compiladas numa única expressão regular (uma alternativa nomeada por regra)
+# e a mensagem é percorrida uma vez só. Cada ocorrência vira um candidato; vence a regra de maior
+# prioridade e a pontuação indica o quão forte foi o sinal (ex.: "com" sozinho é fraco).
+# Novas intenções entram com `roteador.registrar(...)`, sem mexer no fluxo de processamento.
+Intencao = namedtuple("Intencao", ["nome", "pontuacao", "slots"])
+
+INTENCAO_PADRAO = "pergunta_geral"
+
+
+class RoteadorIntencoes:
+    def __init__(self):
+        self._regras = [] # (nome, padrao, prioridade, pontuacao, extrair)
+        self._compilado = None
+        self._grupos = [] # por regra: [(slot, nome do grupo na regex combinada)]
+        self._lock = threading.Lock()
+
+    def registrar(self, nome, padrao, prioridade, pontuacao=1.0, extrair=None):
+        # `padrao` casa a partir do início de uma palavra (o `\b` é comum a todas as regras) e é
+        # aplicado sobre a mensagem em minúsculas. Grupos nomeados (?P<slot>...) viram slots;
+        # `extrair(slots, msg)` ajusta os slots ou devolve None para descartar a ocorrência.
+        with self._lock:
+            self._regras.append((nome, padrao, prioridade, pontuacao, extrair))
+            self._compilado = None
+
+    def _compilar(self):
+        with self._lock:
+            if self._compilado is None:
+                partes, grupos = [], []
+                for i, (_, padrao, _, _, _) in enumerate(self._regras):
+                    grupos.append([(slot, f"r{i}__{slot}") for slot in re.findall(r"\(\?P<(\w+)>", padrao)])
+                    padrao = re.sub(r"\(\?P<(\w+)>", rf"(?P<r{i}__\1>", padrao) # grupos únicos por regra
+                    partes.append(f"(?P<r{i}>{padrao})")
+                self._grupos = grupos
+                # O `\b` fatorado para fora descarta rápido as posições que não iniciam palavra
+                self._compilado = re.compile(r"\b(?:" + "|".join(partes) + ")")
+            return self._compilado
+
+    def classificar(self, msg):
+        msg = msg.lower()
+        candidatos = []
+        for m in self._compilar().finditer(msg):
+            indice = int(m.lastgroup[1:])
+            _, _, prioridade, pontuacao, _ = self._regras[indice]
+            candidatos.append((prioridade, pontuacao, indice, m))
+        # Slots só são montados para o melhor candidato (ou o próximo, se o extrator descartar)
+        if len(candidatos) > 1:
+            candidatos.sort(key=lambda c: (c[0], c[1]), reverse=True)
+        for _, pontuacao, indice, m in candidatos:
+            nome, _, _, _, extrair = self._regras[indice]
+            slots = {}
+            for slot, grupo in self._grupos[indice]:
+                valor = m.group(grupo)
+                if valor is not None:
+                    slots[slot] = valor
+            if extrair is not None:
+                slots = extrair(slots, msg)
+                if slots is None:
+                    continue
+            return Intencao(nome, pontuacao, slots)
+        return Intencao(INTENCAO_PADRAO, 0.0, {"consulta": msg})
+
+
+def _lista_codigos(texto):
+    codigos = []
+    for codigo in re.findall(r"pr\d+", texto):
+        if codigo.upper() not in codigos:
+            codigos.append(codigo.upper())
+    return codigos
+
+
+def _slots_custo(slots, msg):
+    if "codigos" in slots:
+        return {"codigos": _lista_codigos(slots["codigos"])}
+    nome = slots.get("nome", "").strip()
+    if not nome or nome.upper().startswith("PR"): # Garante que não pegue "PR" como nome
+        return None
+    return {"nome": nome}
+
+
+def _slots_preco_venda(slots, msg):
+    markups = [m.replace(',', '.') for m in re.findall(r"\d+(?:[.,]\d+)?", slots["markups"])]
+    return {"codigos": _lista_codigos(slots["codigos"]), "markups": list(dict.fromkeys(markups))}
+
+
+def _slots_busca(slots, msg):
+    return {"termos": [p for p in msg.split() if len(p) > 2]}
+
+
+# Listas: "pr11410, pr11411 e pr20001" / "2, 3 e 3,5" (vírgula seguida de espaço separa; sem espaço é decimal)
+_PADRAO_LISTA_CODIGOS = r"pr\d+(?:(?:\s*[;/]\s*|,\s*|\s+e\s+)(?:d[ao]s?\s+)?pr\d+)*"
+_PADRAO_LISTA_MARKUPS = r"\d+(?:[.,]\d+)?(?:(?:\s*[;/]\s*|,\s+|\s+e\s+)\d+(?:[.,]\d+)?)*"
+
+roteador = RoteadorIntencoes()
+roteador.registrar("valores", r"(?:valores|cultura da empresa|miss[aã]o|princ[ií]pios)", prioridade=40)
+roteador.registrar("custo", rf"custo d[ao]s?\s+(?:(?P<codigos>{_PADRAO_LISTA_CODIGOS})|(?P<nome>.+))", prioridade=30, extrair=_slots_custo)
+roteador.registrar("preco_venda", rf"preço de venda d[ao]s?\s+(?P<codigos>{_PADRAO_LISTA_CODIGOS})\s+com (?:o|os) markups?\s+(?P<markups>{_PADRAO_LISTA_MARKUPS})", prioridade=20, extrair=_slots_preco_venda)
+roteador.registrar("busca_fragrancia", r"(?:fragr[aâ]ncias?|produtos?|cheiros?|cont[eé]m|tem com)\b", prioridade=10, extrair=_slots_busca)
+# "com" aparece em quase toda frase: ainda indica busca por notas, mas com pontuação baixa
+roteador.registrar("busca_fragrancia", r"com\b", prioridade=10, pontuacao=0.3, extrair=_slots_busca)
+
+
+# --- Respostas por template (sem ida à IA) ---
+# Para custo e preço de venda o Python já calcula a resposta inteira; renderizar um template no
+# estilo da Iris leva microssegundos, contra segundos esperando a OpenRouter. Com
+# RESPOSTAS_TEMPLATE=0 essas intenções voltam a ser redigidas pela IA.
+RESPOSTAS_TEMPLATE = os.environ.get("RESPOSTAS_TEMPLATE", "1") == "1"
+
+TEMPLATES_IRIS = {
+    "custo": [
+        "Oba! 🎉 O custo da fragrância *{produto}* é de *{custo}*! 💰✨ Precisa de mais alguma coisa? 😊",
+        "Prontinho! ✨ A *{produto}* tem custo de *{custo}*. 💖 Se quiser, já calculo o preço de venda com o markup que você me disser! 😉",
+        "Achei! 🕵️‍♀️ Custo da *{produto}*: *{custo}* 💸 Conte comigo para o que precisar! 🌸",
+    ],
+    "preco_venda": [
+        "Olá! 🎉 Para a fragrância *{produto}*, com markup *{markup}*, o preço de venda é de *{preco}*! ✨",
+        "Prontinho! 💰 Com markup *{markup}*, a *{produto}* sai por *{preco}*. Boas vendas! 🚀💖",
+        "Calculado! 🧮✨ *{produto}* com markup *{markup}*: preço de venda de *{preco}*. Qualquer coisa, é só chamar! 😊",
+    ],
+    "nao_encontrado": [
+        "Que pena! 😔 Não encontrei o custo da fragrância '{termo}' nos nossos registros. Você digitou o código/nome certinho? Tente novamente! Estou aqui para ajudar! 🕵️‍♀️💖",
+        "Ah, que pena! 😕 Não achei nada com '{termo}' por aqui. Confere o código/nome (ex: PR11410) e me manda de novo? ✨",
+        "Hmm... 🤔 Procurei '{termo}' nos nossos registros e não encontrei um custo válido. Que tal tentar com o código exato? 💖",
+    ],
+    "custo_lote": [
+        "Prontinho! 🎉 Aqui estão os custos que você pediu:\n{tabela}{rodape}\nPrecisa de mais alguma coisa? 😊",
+        "Achei! 🕵️‍♀️💰 Custos das fragrâncias:\n{tabela}{rodape}\nConte comigo! 💖",
+    ],
+    "preco_lote": [
+        "Calculado! 🧮✨ Preços de venda por markup:\n{tabela}{rodape}\nBoas vendas! 🚀💖",
+        "Prontinho! 🎉 Aqui está a tabela de preços de venda:\n{tabela}{rodape}\nQualquer coisa, é só chamar! 😊",
+    ],
+    "varios_produtos": [
+        "Encontrei mais de uma fragrância parecida com '{termo}'! 🌸 Qual delas você quer?\n{lista}\nMe manda o código exato (PRXXXXX) que eu te passo o custo! ✨",
+        "Opa, achei várias opções para '{termo}'! 😊\n{lista}\nQual é a sua? Me diga o código (PRXXXXX) e eu já respondo! 💖",
+    ],
+}
+
+_rodizio_templates = itertools.count() # alterna as frases entre respostas
+
+
+def renderizar_template(intencao, **campos):
+    opcoes = TEMPLATES_IRIS[intencao]
+    return opcoes[next(_rodizio_templates) % len(opcoes)].format(**campos)
+
+
+def formatar_reais(valor):
+    # 1234.5 -> "R$ 1.234,50"
+    return "R$ " + f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def formatar_markup(markup):
+    return f"{markup:g}".replace(".", ",")
+
+
+DIVISOR_PRECO_VENDA = 0.7442 # preço de venda = markup * custo / divisor
+
+
+def _converter_custo(prod):
+    cost_value = prod.get("re_custo")
+    if cost_value is None:
+        return None
+    try:
+        return float(cost_value)
+    except (ValueError, TypeError):
+        logging.warning(f"Custo inválido (não numérico) para {prod.get('pro_in_codigo')}: '{cost_value}'")
+        return None
+
+
+# Vários códigos (e opcionalmente vários markups) numa mensagem: uma consulta só para todos os
+# códigos e uma única resposta consolidada, em vez de uma mensagem por produto.
+def _fluxo_lote(codigos, markups):
+    produtos = yield ("produtos", {"product_codes": codigos})
+    por_codigo = {str(p.get("pro_in_codigo", "")).upper(): p for p in produtos}
+    markups = [float(m) for m in markups]
+    logging.info(f"DEBUG (Lote): Buscou {len(codigos)} códigos, encontrou {len(por_codigo)}.")
+
+    linhas, faltando = [], []
+    for codigo in codigos:
+        prod = por_codigo.get(codigo)
+        custo = _converter_custo(prod) if prod else None
+        if custo is None:
+            faltando.append(codigo)
+        elif not markups:
+            linhas.append(f"• *{codigo}*: {formatar_reais(custo)}")
+        else:
+            linhas.append(f"• *{codigo}* (custo {formatar_reais(custo)})")
+            for markup in markups:
+                linhas.append(f"    markup {formatar_markup(markup)}: *{formatar_reais(markup * custo / DIVISOR_PRECO_VENDA)}*")
+
+    if not linhas:
+        if RESPOSTAS_TEMPLATE:
+            return renderizar_template("nao_encontrado", termo=", ".join(codigos))
+        return f"Que pena! 😔 Não encontrei o custo de nenhuma das fragrâncias {', '.join(codigos)} nos nossos registros. Você digitou os códigos certinho? Tente novamente! 🕵️‍♀️💖"
+
+    tabela = chr(10).join(linhas)
+    rodape = f"\nNão encontrei o custo de: {', '.join(faltando)} 😕" if faltando else ""
+    if RESPOSTAS_TEMPLATE:
+        return renderizar_template("preco_lote" if markups else "custo_lote", tabela=tabela, rodape=rodape)
+
+    pedido = "os preços de venda por markup" if markups else "os custos"
+    prompt = f"""O cliente pediu {pedido} destas fragrâncias. Os valores já calculados são:
+{tabela}{rodape}
+
+Como a Iris, a assistente virtual da Ginger Fragrances, apresente esses valores de forma simpática, clara e organizada, mantendo todos os códigos e valores exatamente como estão. Use emojis! Não explique a fórmula."""
+    return (yield ("ia", prompt))
+
+
+# Fluxo de decisão da resposta, independente de como o I/O é feito.
+# É um gerador: cada chamada externa vira um `yield (tipo, argumento)` e o resultado volta pelo
+# `send`. Assim o mesmo fluxo roda no modo thread (`_executar_fluxo`) e no modo async
+# (`_executar_fluxo_async`). O valor de retorno é o texto a enviar ao cliente.
+#   ("produtos", {"product_code": ...} ou {"search_term": ...}) -> lista de produtos
+#   ("web", consulta) -> lista de snippets da pesquisa
+#   ("notas", palavras) -> linhas "Código: ... - Descrição: ..." das fragrâncias com essas notas
+#   ("ia", prompt) -> texto gerado pela IA
+#   ("paralelo", [passos], prazo) -> resultados dos passos (None para os que passaram do prazo)
+def _fluxo_mensagem(msg):
     resposta_final = ""
 
     try:
+        with medir_etapa("roteamento"):
+            intencao = roteador.classificar(msg)
+        logging.info(f"🧭 Intenção: {intencao.nome} (pontuação {intencao.pontuacao})")
+
         # --- Lógica para responder sobre os valores da empresa ---
-        if any(p in msg for p in ["valores", "nossos valores", "quais os valores", "cultura da empresa", "missao", "princípios"]):
+        if intencao.nome == "valores":
             resposta_final = """🎉 Olá! Que ótimo que você se interessa pelos nossos valores na Ginger Fragrances! ✨ Eles são o coração da nossa empresa e guiam tudo o que fazemos:
 
 * **FOCO NO RESULTADO:** Buscamos sempre a excelência e o impacto positivo.
@@ -197,31 +1325,22 @@ def processar_mensagem_em_segundo_plano(ultramsg_data, numero, msg):
 * **RESPEITO ÀS PESSOAS E AO MEIO AMBIENTE:** Cuidamos do nosso time e do nosso planeta.
 
 Seja bem-vindo(a) à nossa essência! 😊 Quer saber mais sobre nossas fragrâncias incríveis!"""
-            enviar_resposta_ultramsg(numero, resposta_final)
-            return
+            return resposta_final
 
         # --- NOVO: Lógica para informar o custo de uma PR por CÓDIGO OU NOME ---
-        # Regex para capturar "prXXXXX" OU uma frase que pode ser um nome
-        # Grupo 1: captura o código (pr\d+)
-        # Grupo 2: captura o nome (qualquer coisa depois de "custo da " que não seja pr\d+)
-        match_custo = re.search(r"(?:qual o|qual é o|preço de)?\s*custo da\s+(pr\d+)", msg)
-        match_custo_nome = re.search(r"(?:qual o|qual é o|preço de)?\s*custo da\s+(.+)", msg)
-
-        product_code_requested = None
-        product_name_requested = None
-
-        if match_custo:
-            product_code_requested = match_custo.group(1).upper()
-        elif match_custo_nome and not match_custo_nome.group(1).strip().upper().startswith("PR"): # Garante que não pegue "PR" como nome
-            product_name_requested = match_custo_nome.group(1).strip()
-            
-        if product_code_requested or product_name_requested:
+        # O roteador entrega o código ("prXXXXX") ou o nome (o que vier depois de "custo da ")
+        if intencao.nome == "custo":
+            codigos = intencao.slots.get("codigos", [])
+            if len(codigos) > 1:
+                return (yield from _fluxo_lote(codigos, markups=[]))
+            product_code_requested = codigos[0] if codigos else None
+            product_name_requested = intencao.slots.get("nome")
             produtos_encontrados = []
             if product_code_requested:
-                produtos_encontrados = get_products_from_pg(product_code=product_code_requested)
+                produtos_encontrados = yield ("produtos", {"product_code": product_code_requested})
                 logging.info(f"DEBUG (Custo por Código): Buscou {product_code_requested}, encontrou {len(produtos_encontrados)}.")
             elif product_name_requested:
-                produtos_encontrados = get_products_from_pg(search_term=product_name_requested)
+                produtos_encontrados = yield ("produtos", {"search_term": product_name_requested})
                 logging.info(f"DEBUG (Custo por Nome): Buscou '{product_name_requested}', encontrou {len(produtos_encontrados)}.")
 
             if len(produtos_encontrados) == 1:
@@ -236,43 +1355,52 @@ Seja bem-vindo(a) à nossa essência! 😊 Quer saber mais sobre nossas fragrân
                     except (ValueError, TypeError):
                         logging.warning(f"Custo inválido (não numérico) para {product_code_requested or product_name_requested} (custo direto): '{cost_value}'") 
             
-                if found_product_cost is not None:
+                if found_product_cost is not None and RESPOSTAS_TEMPLATE:
+                    produto = product_code_requested or f"{prod.get('pro_in_codigo', 'N/A')} ({prod.get('pro_st_descricao', product_name_requested)})"
+                    resposta_final = renderizar_template("custo", produto=produto, custo=formatar_reais(found_product_cost))
+                elif found_product_cost is not None:
                     prompt = f"""O cliente perguntou 'qual o custo da {product_code_requested or product_name_requested}'.
                     O custo encontrado para '{product_code_requested or product_name_requested}' é R$ {found_product_cost:.2f}.
                     
                     Como a Iris, a assistente virtual da Ginger Fragrances, informe o custo encontrado de forma simpática, clara e objetiva. Mencione o código/nome do produto e o custo. Use emojis!"""
-                    resposta_final = responder_ia(prompt)
+                    resposta_final = yield ("ia", prompt)
+                elif RESPOSTAS_TEMPLATE:
+                    resposta_final = renderizar_template("nao_encontrado", termo=product_code_requested or product_name_requested)
                 else:
                     resposta_final = f"Ah, que pena! 😕 Não consegui encontrar o custo para a fragrância {product_code_requested or product_name_requested} nos nossos registros ou o custo é inválido. Você digitou o código/nome certinho? Tente novamente! ✨"
             elif len(produtos_encontrados) > 1:
                 list_of_products = []
                 for i, prod in enumerate(produtos_encontrados[:5]): # Limita a lista para a IA
                     list_of_products.append(f"{i+1}. Código: {prod.get('pro_in_codigo', 'N/A')} - Descrição: {prod.get('pro_st_descricao', 'N/A')}")
-                
+
+                if RESPOSTAS_TEMPLATE:
+                    return renderizar_template("varios_produtos", termo=product_name_requested, lista=chr(10).join(list_of_products))
+
                 prompt = f"""O cliente perguntou sobre o custo de '{product_name_requested}', mas encontrei múltiplas fragrâncias com nomes ou descrições similares:
 {chr(10).join(list_of_products)}
 
 Como a Iris, a assistente virtual da Ginger Fragrances, explique que encontrou mais de um produto e peça para o cliente especificar qual ele deseja, fornecendo o código exato (PRXXXXX). Seja simpática e útil. ✨"""
-                resposta_final = responder_ia(prompt)
+                resposta_final = yield ("ia", prompt)
 
+            elif RESPOSTAS_TEMPLATE: # Nenhuma PR encontrada por código ou nome
+                resposta_final = renderizar_template("nao_encontrado", termo=product_code_requested or product_name_requested)
             else: # Nenhuma PR encontrada por código ou nome
                 resposta_final = f"Que pena! 😔 Não encontrei nenhuma fragrância com o código ou nome '{product_code_requested or product_name_requested}' nos nossos registros. Você digitou o código/nome certinho? Tente novamente com outro termo. Estou aqui para ajudar! 🕵️‍♀️💖"
             
-            enviar_resposta_ultramsg(numero, resposta_final)
-            return # Finaliza o processamento para esta intenção
+            return resposta_final # Finaliza o processamento para esta intenção
 
         # --- Lógica para calcular preço de venda ---
-        match_preco = re.search(r"(?:qual o|calcule o)?\s*preço de venda da (pr\d+)\s+com o markup\s+(\d+(?:[.,]\d+)?)", msg)
-        
-        if match_preco:
-            product_code_requested = match_preco.group(1).upper() # Ex: PR11410
-            markup_str = match_preco.group(2).replace(',', '.') # Ex: "3" ou "3.5"
+        if intencao.nome == "preco_venda":
+            if len(intencao.slots["codigos"]) > 1 or len(intencao.slots["markups"]) > 1:
+                return (yield from _fluxo_lote(intencao.slots["codigos"], intencao.slots["markups"]))
+            product_code_requested = intencao.slots["codigos"][0] # Ex: PR11410
+            markup_str = intencao.slots["markups"][0] # Ex: "3" ou "3.5"
             
             try:
                 markup = float(markup_str)
-                fixed_divisor = 0.7442
+                fixed_divisor = DIVISOR_PRECO_VENDA
 
-                produtos_encontrados = get_products_from_pg(product_code=product_code_requested)
+                produtos_encontrados = yield ("produtos", {"product_code": product_code_requested})
 
                 found_product_cost = None
                 if produtos_encontrados:
@@ -288,13 +1416,18 @@ Como a Iris, a assistente virtual da Ginger Fragrances, explique que encontrou m
 
                 if found_product_cost is not None:
                     selling_price = (markup * found_product_cost) / fixed_divisor
-                    
+
+                    if RESPOSTAS_TEMPLATE:
+                        return renderizar_template("preco_venda", produto=product_code_requested, markup=formatar_markup(markup), preco=formatar_reais(selling_price))
+
                     prompt = f"""O cliente pediu para calcular o preço de venda da fragrância '{product_code_requested}' com um markup de {markup}.
                     O custo encontrado para '{product_code_requested}' foi de R$ {found_product_cost:.2f}.
                     O preço de venda calculado é R$ {selling_price:.2f}.
                     
                     Como a Iris, a assistente virtual da Ginger Fragrances, informe o preço de venda calculado de forma simpática, clara e objetiva. Mencione o código do produto, o markup usado e o preço final. Use emojis! Não explique a fórmula. Exemplo: 'Olá! Para a fragrância [código], com markup [x], o preço de venda é de R$ [valor]! ✨'"""
-                    resposta_final = responder_ia(prompt)
+                    resposta_final = yield ("ia", prompt)
+                elif RESPOSTAS_TEMPLATE:
+                    resposta_final = renderizar_template("nao_encontrado", termo=product_code_requested)
                 else:
                     resposta_final = f"Ah, que pena! 😕 Não consegui encontrar o custo para a fragrância {product_code_requested} nos nossos registros. Você digitou o código certinho? Tente novamente ou me diga sobre qual fragrância você gostaria de calcular o preço de venda! ✨"
             except ValueError:
@@ -303,66 +1436,1098 @@ Como a Iris, a assistente virtual da Ginger Fragrances, explique que encontrou m
                 logging.error(f"❌ Erro ao calcular preço/consultar DB: {e}", exc_info=True)
                 resposta_final = "Desculpe, tive um problema ao calcular o preço agora. Nossos sistemas estão um pouco tímidos! Tente novamente mais tarde! 😥"
 
-            enviar_resposta_ultramsg(numero, resposta_final)
-            return
+            return resposta_final
 
         # Lógica para busca de fragrâncias por descrição (se o cliente não pediu cálculo nem valores)
-        elif any(p in msg for p in ["fragrância", "fragrancia", "produto", "tem com", "contém", "cheiro", "com"]):
-            # --- MUDANÇA AQUI: Chamar get_products_from_pg diretamente ---
-            # Extrair termo de busca da mensagem do cliente para passar para a função
-            search_term_for_db = " ".join([p for p in msg.split() if len(p) > 2]) 
-            produtos = get_products_from_pg(search_term=search_term_for_db)
-
-            palavras_chave = [p for p in msg.split() if len(p) > 2] 
-
-            achados = []
-            for prod in produtos: 
-                descricao = prod.get("pro_st_descricao", "").lower() 
-                codigo = prod.get("pro_in_codigo", "")             
-                if any(termo in descricao for termo in palavras_chave):
-                    achados.append(f"Código: {codigo} - Descrição: {descricao}")
-                    if len(achados) >= 5: 
-                        break
+        # Mensagem ambígua: catálogo e web ao mesmo tempo
+        elif FANOUT_ATIVO and _mensagem_ambigua(intencao):
+            resposta_final = yield from _fluxo_especulativo(msg, intencao.slots["termos"])
+
+        elif intencao.nome == "busca_fragrancia":
+            # Termos de busca (notas olfativas) extraídos da mensagem do cliente
+            palavras_chave = intencao.slots["termos"]
+
+            achados = yield ("notas", palavras_chave)
 
             if not achados:
                 resposta_final = "Que pena! 😔 Não encontrei nenhuma fragrância com essa descrição. Mas não desanime! Nossos produtos são um universo de aromas! Que tal tentar com outras palavras-chave ou me dar mais detalhes sobre o cheiro que você imagina? Estou pronta para a próxima busca! 🕵️‍♀️💖"
             else:
-                prompt = f"""Com base nestes produtos incríveis que encontrei para você:
-{chr(10).join(achados)}
-Por favor, como a Iris, a assistente virtual super animada da Ginger Fragrances, responda ao cliente de forma **super simpática, vibrante e concisa**, listando os códigos e descrições dos produtos encontrados **apenas uma vez, em um formato divertido e fácil de ler**! Convide-o com entusiasmo a perguntar sobre outras maravilhas perfumadas se ainda não for exatamente o que ele busca! ✨"""
-                resposta_final = responder_ia(prompt)
+                resposta_final = yield ("ia", _prompt_fragrancias(achados))
         # Lógica para pesquisa web (perguntas gerais)
         else: 
-            search_query = msg
-            snippets = perform_google_custom_search(search_query) 
-            
-            search_results_text = ""
-            if snippets:
-                search_results_text = "\n".join(snippets)
+            snippets = yield ("web", msg)
+            resposta_final = yield ("ia", _prompt_web(msg, snippets))
+
+    except Exception as e:
+        logging.error(f"❌ Erro inesperado durante o processamento da mensagem em segundo plano: {e}", exc_info=True)
+        resposta_final = RESPOSTA_ERRO_PROCESSAMENTO
+
+    return resposta_final
+
+
+# --- Busca especulativa para mensagens ambíguas ---
+# Quando o roteador não tem certeza (busca de fragrância só por um "com" solto), o catálogo e a pesquisa
+# web rodam ao mesmo tempo, com um prazo comum. O prompt usa o que chegou a tempo; o que atrasar é
+# ignorado. A latência fica max(catálogo, web) em vez da soma, e a mensagem não cai num beco sem saída.
+FANOUT_ATIVO = os.environ.get("FANOUT_ATIVO", "1") == "1"
+FANOUT_LIMIAR = float(os.environ.get("FANOUT_LIMIAR", "0.5")) # pontuação do roteador abaixo disso = ambígua
+FANOUT_PRAZO_S = float(os.environ.get("FANOUT_PRAZO_S", "4")) # segundos
+# Cada mensagem ambígua ocupa 2 threads, e um passo atrasado segue rodando depois do prazo
+# (não dá para interromper uma requisição em andamento): o padrão é 2 por worker de mensagens
+# mais folga, para os passos não ficarem na fila do executor e perderem o prazo antes de começar
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", str(2 * int(os.environ.get("WEBHOOK_WORKERS", "8")) + 4)))
+
+_executor_fanout = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
 
-            if search_results_text:
-                prompt = f"""Mensagem do cliente: '{msg}'.
+
+def _mensagem_ambigua(intencao):
+    # Perguntas gerais (nenhuma regra casou) vão direto para a web: buscar notas nelas só varre o banco
+    return intencao.nome == "busca_fragrancia" and intencao.pontuacao < FANOUT_LIMIAR
+
+
+def _prompt_fragrancias(achados):
+    return f"""Com base nestes produtos incríveis que encontrei para você:
+{chr(10).join(achados)}
+Por favor, como a Iris, a assistente virtual super animada da Ginger Fragrances, responda ao cliente de forma **super simpática, vibrante e concisa**, listando os códigos e descrições dos produtos encontrados **apenas uma vez, em um formato divertido e fácil de ler**! Convide-o com entusiasmo a perguntar sobre outras maravilhas perfumadas se ainda não for exatamente o que ele busca! ✨"""
+
+
+def _prompt_web(msg, snippets):
+    if snippets:
+        search_results_text = "\n".join(snippets)
+        return f"""Mensagem do cliente: '{msg}'.
                 Informações da web encontradas:
                 {search_results_text}
                 
                 Com base na mensagem do cliente e nas informações da web (se relevantes), como a Iris, a assistente virtual da Ginger Fragrances, responda de forma super simpática, animada e útil. Se a pergunta for geral, use as informações da web para responder de forma concisa. Se for sobre fragrâncias e a pesquisa não ajudar a encontrar um produto específico, convide-o a perguntar sobre notas olfativas ou outros detalhes. Lembre-se de sua personalidade única e responda apenas uma vez! ✨"""
+    return f"Mensagem do cliente: '{msg}'. Responda como a Iris, a assistente virtual da Ginger Fragrances, se apresentando e convidando-o a perguntar sobre fragrâncias específicas ou notas olfativas. Parece que não encontrei informações adicionais na web para isso no momento. 🤔 Que tal explorar o mundo dos cheirinhos? 😊"
+
+
+def _fluxo_especulativo(msg, palavras_chave):
+    achados, snippets = yield ("paralelo", [("notas", palavras_chave), ("web", msg)], FANOUT_PRAZO_S)
+    achados, snippets = achados or [], snippets or []
+    logging.info(f"🔀 Busca especulativa: {len(achados)} produtos e {len(snippets)} resultados da web a tempo.")
+
+    if achados and snippets:
+        prompt = f"""Mensagem do cliente: '{msg}'.
+Fragrâncias do nosso catálogo que podem combinar com a mensagem:
+{chr(10).join(achados)}
+Informações da web encontradas:
+{chr(10).join(snippets)}
+
+Como a Iris, a assistente virtual da Ginger Fragrances, responda de forma super simpática, animada e concisa. Se a mensagem descrever um cheiro ou notas olfativas, indique as fragrâncias relevantes com seus códigos; se for uma pergunta geral, use as informações da web. Ignore o que não for relevante e responda apenas uma vez! ✨"""
+    elif achados:
+        prompt = _prompt_fragrancias(achados)
+    else:
+        prompt = _prompt_web(msg, snippets)
+    return (yield ("ia", prompt))
+
+
+def _executar_passo_ou_none(tipo, argumento):
+    try:
+        return _executar_passo(tipo, argumento)
+    except Exception as e:
+        logging.error(f"❌ Erro em passo paralelo: {e}")
+        return None
+
+
+# Executa vários passos ao mesmo tempo; o que não terminar dentro do prazo vira None
+def _executar_paralelo(passos, prazo):
+    try:
+        # Cada passo roda com uma cópia do contexto, para as etapas entrarem no trace da mensagem
+        futuros = [_executor_fanout.submit(contextvars.copy_context().run, _executar_passo, *passo) for passo in passos]
+    except RuntimeError:
+        # Desligando: o interpretador fecha os executores antes do atexit, então durante a drenagem
+        # da fila os passos rodam em sequência na própria thread do worker
+        return [_executar_passo_ou_none(*passo) for passo in passos]
+    concluidos, pendentes = wait(futuros, timeout=prazo)
+    for futuro in pendentes:
+        futuro.cancel() # se já estiver rodando, termina em segundo plano e o resultado é descartado
+    resultados = []
+    for futuro in futuros:
+        if futuro in concluidos and futuro.exception() is None:
+            resultados.append(futuro.result())
+        else:
+            if futuro in concluidos:
+                logging.error(f"❌ Erro em passo paralelo: {futuro.exception()}")
+            resultados.append(None)
+    return resultados
+
+
+RESPOSTA_ERRO_PROCESSAMENTO = "Oh-oh! 🥺 Algo inesperado aconteceu enquanto eu estava buscando a resposta perfeita para você! Mas não se preocupe, o time da Ginger Fragrances já foi avisado e estamos correndo pra resolver isso! Por favor, tente novamente em alguns instantes. Sua satisfação é nosso cheirinho favorito! 😉"
+
+
+def _executar_passo(tipo, argumento):
+    with medir_etapa(tipo):
+        return _executar_passo_sem_medir(tipo, argumento)
+
+
+def _executar_passo_sem_medir(tipo, argumento):
+    if tipo == "produtos":
+        return buscar_produtos(**argumento)
+    if tipo == "web":
+        return pesquisar_web(argumento)
+    if tipo == "notas":
+        return buscar_por_notas(argumento)
+    if tipo == "ia":
+        return responder_ia(argumento)
+    raise ValueError(f"Passo desconhecido no fluxo da mensagem: {tipo}")
+
+
+def _executar_fluxo(fluxo):
+    try:
+        passo = next(fluxo)
+        while True:
+            if passo[0] == "paralelo":
+                passo = fluxo.send(_executar_paralelo(*passo[1:]))
             else:
-                prompt = f"Mensagem do cliente: '{msg}'. Responda como a Iris, a assistente virtual da Ginger Fragrances, se apresentando e convidando-o a perguntar sobre fragrâncias específicas ou notas olfativas. Parece que não encontrei informações adicionais na web para isso no momento. 🤔 Que tal explorar o mundo dos cheirinhos? 😊"
-            
-            resposta_final = responder_ia(prompt)
+                passo = fluxo.send(_executar_passo(*passo))
+    except StopIteration as fim:
+        return fim.value
+
+
+# Função principal de processamento da mensagem (executada em segundo plano)
+def processar_mensagem_em_segundo_plano(ultramsg_data, numero, msg, jobs=()):
+    logging.info(f"📩 [Processamento em Segundo Plano] Mensagem recebida de {numero}: '{msg}'")
+    with rastrear_mensagem(numero), medir_etapa("total"):
+        try:
+            resposta_final = _executar_fluxo(_fluxo_mensagem(msg))
+        except Exception as e:
+            logging.error(f"❌ Erro inesperado durante o processamento da mensagem em segundo plano: {e}", exc_info=True)
+            resposta_final = RESPOSTA_ERRO_PROCESSAMENTO
+
+        _registrar_resposta_fila(jobs, resposta_final)
+        with medir_etapa("envio"):
+            enviado = enviar_resposta_ultramsg(numero, resposta_final)
+        _resultado_envio_fila(jobs, enviado)
+
+
+
+# --- Pool de workers para o processamento das mensagens ---
+# Um número fixo de threads atende uma fila limitada. Mensagens do mesmo número são processadas
+# em ordem (FIFO por remetente), enquanto números diferentes andam em paralelo.
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_FILA_MAX = int(os.environ.get("WEBHOOK_FILA_MAX", "200")) # mensagens aguardando processamento
+WEBHOOK_POLITICA_EXCESSO = os.environ.get("WEBHOOK_POLITICA_EXCESSO", "responder") # "responder" ou "descartar"
+WEBHOOK_DRENAGEM_TIMEOUT = float(os.environ.get("WEBHOOK_DRENAGEM_TIMEOUT", "25")) # segundos para esvaziar a fila ao desligar
+
+MENSAGEM_FILA_CHEIA = "Uau, quanta gente querendo falar comigo agora! 🤯 Estou atendendo muitos pedidos ao mesmo tempo. Me manda sua mensagem de novo daqui a pouquinho que eu te respondo rapidinho! 💖"
+
+
+class DespachanteMensagens:
+    def __init__(self, workers, fila_max):
+        self.workers = workers
+        self.fila_max = fila_max
+        self._cond = threading.Condition()
+        self._filas = {} # remetente -> deque de tarefas (existe enquanto houver tarefa pendente ou em execução)
+        self._prontos = deque() # remetentes com tarefa pendente e nenhum worker cuidando deles
+        self._pendentes = 0
+        self._ativos = 0
+        self._aceitando = True
+        self._parar = False
+        self._threads = []
+        self._metricas = {"aceitas": 0, "rejeitadas": 0, "processadas": 0, "falhas": 0}
+
+    def iniciar(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"worker-mensagens-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enviar(self, remetente, funcao, *args):
+        # Retorna False quando a fila está cheia (ou desligando); quem chamou decide o que fazer
+        with self._cond:
+            if not self._aceitando or self._pendentes >= self.fila_max:
+                self._metricas["rejeitadas"] += 1
+                return False
+            fila = self._filas.get(remetente)
+            if fila is None:
+                fila = self._filas[remetente] = deque()
+                self._prontos.append(remetente)
+            fila.append((funcao, args))
+            self._pendentes += 1
+            self._metricas["aceitas"] += 1
+            self._cond.notify()
+            return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._prontos and not self._parar:
+                    self._cond.wait()
+                if not self._prontos:
+                    return
+                remetente = self._prontos.popleft()
+                funcao, args = self._filas[remetente].popleft()
+                self._pendentes -= 1
+                self._ativos += 1
+            try:
+                funcao(*args)
+                falhou = False
+            except Exception as e:
+                logging.error(f"❌ Erro não tratado no worker de mensagens ({remetente}): {e}", exc_info=True)
+                falhou = True
+            with self._cond:
+                self._ativos -= 1
+                self._metricas["falhas" if falhou else "processadas"] += 1
+                if self._filas[remetente]:
+                    self._prontos.append(remetente)
+                    self._cond.notify()
+                else:
+                    del self._filas[remetente]
+                self._cond.notify_all() # acorda quem espera a drenagem
+
+    def encerrar(self, timeout=WEBHOOK_DRENAGEM_TIMEOUT):
+        # Para de aceitar mensagens e espera as pendentes terminarem (até `timeout` segundos)
+        limite = time.monotonic() + timeout
+        with self._cond:
+            self._aceitando = False
+            logging.info(f"🛑 Drenando fila de mensagens: {self._pendentes} pendentes, {self._ativos} em processamento.")
+            while self._pendentes or self._ativos:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    logging.warning(f"⚠️ Drenagem expirou com {self._pendentes} mensagens pendentes e {self._ativos} em processamento.")
+                    break
+                self._cond.wait(restante)
+            self._parar = True
+            self._cond.notify_all()
+
+    def estatisticas(self):
+        with self._cond:
+            dados = dict(self._metricas)
+            dados["pendentes"] = self._pendentes
+            dados["ativos"] = self._ativos
+        dados["workers"] = self.workers
+        dados["fila_max"] = self.fila_max
+        return dados
+
+
+despachante = DespachanteMensagens(WEBHOOK_WORKERS, WEBHOOK_FILA_MAX)
+
+
+# --- Modo async: pipeline de mensagens em um único event loop ---
+# Com PROCESSAMENTO_MODO=async, cada mensagem vira uma corrotina num event loop dedicado
+# (rodando numa thread ao lado do Flask). As esperas por Postgres, Google, OpenRouter e
+# UltraMsg não prendem uma thread do SO cada, então milhares de conversas podem aguardar a IA
+# ao mesmo tempo. Requer `aiohttp` e `asyncpg`; sem eles o app continua no modo thread.
+PROCESSAMENTO_MODO = os.environ.get("PROCESSAMENTO_MODO", "thread") # "thread" ou "async"
+ASYNC_MAX_EM_VOO = int(os.environ.get("ASYNC_MAX_EM_VOO", "500")) # mensagens processando ao mesmo tempo
+ASYNC_FILA_MAX = int(os.environ.get("ASYNC_FILA_MAX", "5000")) # mensagens aceitas e ainda não concluídas
+ASYNC_HTTP_CONEXOES = int(os.environ.get("ASYNC_HTTP_CONEXOES", "100"))
+
+try:
+    import aiohttp
+    import asyncpg
+except ImportError:
+    aiohttp = None
+    asyncpg = None
+
+
+# Chamadas que tocam o SQLite (cache em disco, fila persistente) podem esperar pelo lock do arquivo
+# compartilhado: rodam no pool de threads do loop para não travar as outras conversas
+async def _fora_do_loop(funcao, *args):
+    try:
+        futuro = asyncio.get_running_loop().run_in_executor(None, funcao, *args)
+    except RuntimeError:
+        # Desligando: o interpretador fecha os executores antes do atexit; durante a drenagem não
+        # chegam mensagens novas, então rodar no próprio loop não atrasa ninguém
+        return funcao(*args)
+    return await futuro
 
+
+async def get_products_from_pg_async(pg, product_code=None, search_term=None, product_codes=None):
+    query = "SELECT pro_in_codigo, pro_st_descricao, re_custo FROM produtos"
+    params = []
+    if product_code:
+        query += " WHERE UPPER(pro_in_codigo) = $1"
+        params.append(product_code.upper())
+        logging.info(f"DB Query (async): Buscando produto pelo código: {product_code}")
+    elif product_codes:
+        query += " WHERE UPPER(pro_in_codigo) = ANY($1::text[])"
+        params.append([codigo.upper() for codigo in product_codes])
+        logging.info(f"DB Query (async): Buscando produtos pelos códigos: {', '.join(product_codes)}")
+    elif search_term:
+        query += " WHERE LOWER(pro_st_descricao) LIKE $1 LIMIT 50"
+        params.append(f"%{search_term.lower()}%")
+        logging.info(f"DB Query (async): Buscando produtos por termo: {search_term}")
+    try:
+        with medir_etapa("postgres"):
+            rows = [dict(r) for r in await pg.fetch(query, *params)]
+        logging.info(f"DB Query (async) retornou {len(rows)} linhas.")
+        return rows
+    except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+        logging.error(f"❌ Erro ao consultar PostgreSQL DB (async): {e}", exc_info=True)
+        return []
+
+
+async def perform_google_custom_search_async(sessao, query):
+    params = {"key": SEARCH_API_KEY, "cx": SEARCH_CX, "q": query, "num": 3}
+    tentativas = 1 + HTTP_RETENTATIVAS # GET idempotente: mesma política de `requisicao_http`
+    try:
+        for tentativa in range(tentativas):
+            inicio = time.monotonic()
+            try:
+                async with sessao.get(GOOGLE_CSE_URL, params=params, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                    if resp.status not in HTTP_STATUS_RETENTAVEIS or tentativa == tentativas - 1:
+                        resp.raise_for_status()
+                        return _extrair_snippets(await resp.json())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if tentativa == tentativas - 1:
+                    raise
+            finally:
+                LATENCIAS_UPSTREAM["google_cse"].observar(time.monotonic() - inicio)
+            await asyncio.sleep(_pausa_backoff(tentativa))
     except Exception as e:
-        logging.error(f"❌ Erro inesperado durante o processamento da mensagem em segundo plano: {e}", exc_info=True)
-        resposta_final = "Oh-oh! 🥺 Algo inesperado aconteceu enquanto eu estava buscando a resposta perfeita para você! Mas não se preocupe, o time da Ginger Fragrances já foi avisado e estamos correndo pra resolver isso! Por favor, tente novamente em alguns instantes. Sua satisfação é nosso cheirinho favorito! 😉"
+        logging.error(f"❌ Erro ao realizar pesquisa com Google Custom Search API (async): {e}", exc_info=True)
+        return []
+
+
+async def enviar_resposta_ultramsg_async(sessao, numero, body):
+    try:
+        data = {"token": ULTRAMSG_TOKEN, "to": numero, "body": body}
+        inicio = time.monotonic()
+        try:
+            async with sessao.post(ULTRAMSG_URL, data=data, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                resp.raise_for_status()
+                logging.info(f"✅ Resposta enviada para {numero}. UltraMsg retornou: {await resp.text()}")
+        finally:
+            LATENCIAS_UPSTREAM["ultramsg"].observar(time.monotonic() - inicio)
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"❌ Erro ao enviar resposta via UltraMsg para {numero} (async): {e}", exc_info=True)
+        return False
+
+
+async def responder_ia_async(sessao, prompt):
+    headers, body = _montar_requisicao_ia(prompt)
+    chave_cache = _chave_cache_ia(body)
+    if cache_ia is not None:
+        em_cache = await _fora_do_loop(cache_ia.obter, chave_cache)
+        if em_cache is not None:
+            return em_cache
+    inicio = time.monotonic()
+    try:
+        try:
+            async with sessao.post(OPENROUTER_URL, headers=headers, json=body, timeout=aiohttp.ClientTimeout(total=30)) as r:
+                r.raise_for_status()
+                texto = await r.text()
+        finally:
+            LATENCIAS_UPSTREAM["openrouter"].observar(time.monotonic() - inicio)
+        return await _fora_do_loop(_guardar_resposta_ia, chave_cache, _extrair_resposta_ia(json.loads(texto)))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"❌ Erro ao comunicar com a API da OpenRouter (async): {e}", exc_info=True)
+        return RESPOSTA_IA_INDISPONIVEL
+    except json.JSONDecodeError:
+        logging.error(f"❌ Resposta da IA não é um JSON válido (async). Resposta: {texto}", exc_info=True)
+        return RESPOSTA_IA_INVALIDA
+    except Exception as e:
+        logging.error(f"❌ Erro inesperado ao processar resposta da IA (async): {e}", exc_info=True)
+        return RESPOSTA_IA_ERRO
+
+
+class RuntimeAsync:
+    def __init__(self, max_em_voo, fila_max):
+        self.max_em_voo = max_em_voo
+        self.fila_max = fila_max
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._rodar_loop, name="event-loop-mensagens", daemon=True)
+        self._cond = threading.Condition()
+        self._em_voo = 0 # aceitas e ainda não concluídas (contado fora do loop)
+        self._ativos = 0
+        self._aceitando = True
+        self._travas = {} # remetente -> [asyncio.Lock, referências]; mantém a ordem por número
+        self._metricas = {"aceitas": 0, "rejeitadas": 0, "processadas": 0, "falhas": 0}
+        self._sessao = None
+        self._pg = None
+        self._pg_lock = None
+        self._limite = None
+
+    def _rodar_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _preparar(self):
+        conector = aiohttp.TCPConnector(limit=ASYNC_HTTP_CONEXOES, keepalive_timeout=60) # keep-alive compartilhado por todos os serviços
+        self._sessao = aiohttp.ClientSession(connector=conector)
+        self._pg_lock = asyncio.Lock()
+        self._limite = asyncio.Semaphore(self.max_em_voo)
+
+    def iniciar(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._preparar(), self.loop).result()
+        logging.info(f"⚡ Processamento async iniciado (máx. {self.max_em_voo} mensagens simultâneas).")
+
+    async def _obter_pg(self):
+        # Pool asyncpg criado sob demanda (só é usado quando o catálogo em memória não resolve)
+        if self._pg is None:
+            async with self._pg_lock:
+                if self._pg is None:
+                    self._pg = await asyncpg.create_pool(
+                        host=PG_DB_HOST,
+                        database=PG_DB_NAME,
+                        user=PG_DB_USER,
+                        password=PG_DB_PASSWORD,
+                        port=int(PG_DB_PORT),
+                        ssl=PG_SSLMODE,
+                        min_size=PG_POOL_MIN,
+                        max_size=PG_POOL_MAX,
+                    )
+        return self._pg
+
+    async def buscar_produtos(self, product_code=None, search_term=None, product_codes=None):
+        # Mesma lógica de `buscar_produtos`, com o PostgreSQL via asyncpg
+        if catalogo.carregado:
+            if product_codes:
+                produtos, faltando = catalogo.por_codigos(product_codes)
+                if faltando:
+                    do_banco = await get_products_from_pg_async(await self._obter_pg(), product_codes=faltando)
+                    catalogo.aplicar_alteracoes(do_banco)
+                    produtos.extend(do_banco)
+                return produtos
+            if product_code:
+                prod = catalogo.por_codigo(product_code)
+                if prod:
+                    return [prod]
+                produtos = await get_products_from_pg_async(await self._obter_pg(), product_code=product_code)
+                catalogo.aplicar_alteracoes(produtos)
+                return produtos
+            elif search_term:
+                return catalogo.buscar_substring(search_term)
+        return await get_products_from_pg_async(await self._obter_pg(), product_code=product_code, search_term=search_term, product_codes=product_codes)
+
+    async def buscar_por_notas(self, palavras_chave):
+        # Mesma lógica de `buscar_por_notas`, com o PostgreSQL via asyncpg quando não há catálogo
+        if not _tem_termo_de_busca(palavras_chave) or catalogo.carregado:
+            return buscar_por_notas(palavras_chave)
+        produtos = await get_products_from_pg_async(await self._obter_pg(), search_term=" ".join(palavras_chave))
+        return _filtrar_por_notas(produtos, palavras_chave)
+
+    async def pesquisar_web(self, consulta):
+        # Mesma lógica de `pesquisar_web` (cache + limite de cota), com o cliente async
+        chave = normalizar_consulta(consulta)
+        snippets = await _fora_do_loop(_busca_em_cache, chave)
+        if snippets is not None:
+            return snippets
+        if not _busca_permitida(consulta):
+            return []
+        return await _fora_do_loop(_guardar_busca, chave, await perform_google_custom_search_async(self._sessao, consulta))
 
-    enviar_resposta_ultramsg(numero, resposta_final)
+    async def _executar_passo(self, tipo, argumento):
+        with medir_etapa(tipo):
+            return await self._executar_passo_sem_medir(tipo, argumento)
+
+    async def _executar_passo_sem_medir(self, tipo, argumento):
+        if tipo == "produtos":
+            return await self.buscar_produtos(**argumento)
+        if tipo == "web":
+            return await self.pesquisar_web(argumento)
+        if tipo == "notas":
+            return await self.buscar_por_notas(argumento)
+        if tipo == "ia":
+            return await responder_ia_async(self._sessao, argumento)
+        raise ValueError(f"Passo desconhecido no fluxo da mensagem: {tipo}")
+
+    async def _executar_paralelo(self, passos, prazo):
+        tarefas = [asyncio.ensure_future(self._executar_passo(*passo)) for passo in passos]
+        concluidas, pendentes = await asyncio.wait(tarefas, timeout=prazo)
+        for tarefa in pendentes:
+            tarefa.cancel()
+        resultados = []
+        for tarefa in tarefas:
+            if tarefa in concluidas and tarefa.exception() is None:
+                resultados.append(tarefa.result())
+            else:
+                if tarefa in concluidas:
+                    logging.error(f"❌ Erro em passo paralelo (async): {tarefa.exception()}")
+                resultados.append(None)
+        return resultados
+
+    async def _executar_fluxo(self, fluxo):
+        try:
+            passo = next(fluxo)
+            while True:
+                if passo[0] == "paralelo":
+                    passo = fluxo.send(await self._executar_paralelo(*passo[1:]))
+                else:
+                    passo = fluxo.send(await self._executar_passo(*passo))
+        except StopIteration as fim:
+            return fim.value
+
+    async def processar_mensagem(self, ultramsg_data, numero, msg, jobs=()):
+        logging.info(f"📩 [Processamento Async] Mensagem recebida de {numero}: '{msg}'")
+        with rastrear_mensagem(numero), medir_etapa("total"):
+            try:
+                resposta_final = await self._executar_fluxo(_fluxo_mensagem(msg))
+            except Exception as e:
+                logging.error(f"❌ Erro inesperado durante o processamento async da mensagem: {e}", exc_info=True)
+                resposta_final = RESPOSTA_ERRO_PROCESSAMENTO
+            await _fora_do_loop(_registrar_resposta_fila, jobs, resposta_final)
+            with medir_etapa("envio"):
+                enviado = await enviar_resposta_ultramsg_async(self._sessao, numero, resposta_final)
+            await _fora_do_loop(_resultado_envio_fila, jobs, enviado)
+
+    def enviar(self, remetente, ultramsg_data, numero, msg, jobs=()):
+        # Chamado pelas threads do Flask; retorna False quando a fila está cheia
+        with self._cond:
+            if not self._aceitando or self._em_voo >= self.fila_max:
+                self._metricas["rejeitadas"] += 1
+                return False
+            self._em_voo += 1
+            self._metricas["aceitas"] += 1
+        asyncio.run_coroutine_threadsafe(self._executar(remetente, ultramsg_data, numero, msg, jobs), self.loop)
+        return True
+
+    async def _executar(self, remetente, ultramsg_data, numero, msg, jobs):
+        # As corrotinas começam na ordem de chegada e o asyncio.Lock é FIFO: ordem preservada por número
+        trava = self._travas.setdefault(remetente, [asyncio.Lock(), 0])
+        trava[1] += 1
+        falhou = False
+        try:
+            async with trava[0], self._limite:
+                with self._cond:
+                    self._ativos += 1
+                try:
+                    await self.processar_mensagem(ultramsg_data, numero, msg, jobs)
+                finally:
+                    with self._cond:
+                        self._ativos -= 1
+        except Exception as e:
+            logging.error(f"❌ Erro não tratado no processamento async ({remetente}): {e}", exc_info=True)
+            falhou = True
+        finally:
+            trava[1] -= 1
+            if not trava[1]:
+                del self._travas[remetente]
+            with self._cond:
+                self._em_voo -= 1
+                self._metricas["falhas" if falhou else "processadas"] += 1
+                self._cond.notify_all()
+
+    async def _fechar(self):
+        await self._sessao.close()
+        if self._pg is not None:
+            await self._pg.close()
+
+    def encerrar(self, timeout=WEBHOOK_DRENAGEM_TIMEOUT):
+        limite = time.monotonic() + timeout
+        with self._cond:
+            self._aceitando = False
+            logging.info(f"🛑 Drenando processamento async: {self._em_voo} mensagens em andamento.")
+            while self._em_voo:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    logging.warning(f"⚠️ Drenagem async expirou com {self._em_voo} mensagens em andamento.")
+                    break
+                self._cond.wait(restante)
+        try:
+            asyncio.run_coroutine_threadsafe(self._fechar(), self.loop).result(5)
+        except Exception as e:
+            logging.warning(f"⚠️ Erro ao fechar clientes async: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def estatisticas(self):
+        with self._cond:
+            dados = dict(self._metricas)
+            dados["pendentes"] = self._em_voo - self._ativos
+            dados["ativos"] = self._ativos
+        dados["workers"] = self.max_em_voo
+        dados["fila_max"] = self.fila_max
+        return dados
+
+
+runtime_async = None
+if PROCESSAMENTO_MODO == "async":
+    if aiohttp is None or asyncpg is None:
+        logging.error("❌ PROCESSAMENTO_MODO=async exige os pacotes 'aiohttp' e 'asyncpg'. Usando o modo thread.")
+    else:
+        runtime_async = RuntimeAsync(ASYNC_MAX_EM_VOO, ASYNC_FILA_MAX)
+
+# Entrega a mensagem para o modo de processamento configurado. Retorna False se a fila estiver cheia.
+def despachar_mensagem(ultramsg_data, numero, msg, jobs=()):
+    if runtime_async is not None:
+        return runtime_async.enviar(numero, ultramsg_data, numero, msg, jobs)
+    return despachante.enviar(numero, processar_mensagem_em_segundo_plano, ultramsg_data, numero, msg, jobs)
+
+
+# --- Fila persistente de mensagens ---
+# Cada mensagem aceita pelo webhook é gravada num SQLite local (modo WAL) antes de ser processada,
+# junto com o estado da resposta. Se o processo cair no meio (deploy, crash), as mensagens que não
+# terminaram são reprocessadas ao subir, e respostas que a UltraMsg recusou são reenviadas com backoff.
+#   recebida -> respondida -> enviada     (ou "falhou" depois de FILA_MAX_TENTATIVAS envios)
+#   agrupada: fragmento respondido junto com outra mensagem | descartada: recusada por fila cheia
+FILA_ATIVA = os.environ.get("FILA_ATIVA", "1") == "1"
+FILA_ARQUIVO = os.environ.get("FILA_ARQUIVO", "fila_mensagens.sqlite3")
+FILA_MAX_TENTATIVAS = int(os.environ.get("FILA_MAX_TENTATIVAS", "6")) # envios à UltraMsg por resposta
+FILA_BACKOFF_BASE = float(os.environ.get("FILA_BACKOFF_BASE", "5")) # segundos; dobra a cada falha de envio
+FILA_INTERVALO_REENVIO = float(os.environ.get("FILA_INTERVALO_REENVIO", "2")) # segundos entre varreduras
+FILA_LEASE_ENVIO = float(os.environ.get("FILA_LEASE_ENVIO", "60")) # segundos reservando uma resposta em envio (> timeout da UltraMsg)
+FILA_RETENCAO = float(os.environ.get("FILA_RETENCAO", str(7 * 24 * 3600))) # segundos guardando mensagens concluídas
+
+
+class FilaPersistente:
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self._local = threading.local() # uma conexão SQLite por thread
+        self._lock = threading.Lock()
+        self._metricas = {"registradas": 0, "duplicadas": 0, "reprocessadas": 0, "reenvios": 0, "falhas_envio": 0}
+        with self._conexao() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS mensagens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id_mensagem TEXT UNIQUE,
+                numero TEXT NOT NULL,
+                corpo TEXT NOT NULL,
+                dados TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                resposta TEXT,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                proxima_tentativa REAL,
+                dono INTEGER,
+                criado_em REAL NOT NULL,
+                atualizado_em REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS mensagens_estado ON mensagens (estado, proxima_tentativa)")
+
+    def _conexao(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.arquivo, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL") # no WAL, só o checkpoint faz fsync: gravação barata
+            self._local.conn = conn
+        return conn
+
+    def _contar(self, metrica, n=1):
+        with self._lock:
+            self._metricas[metrica] += n
+
+    def registrar(self, ultramsg_data, numero, msg):
+        # Retorna o id do registro, ou None se essa mensagem (mesmo id da UltraMsg) já foi recebida
+        agora = time.time()
+        with self._conexao() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO mensagens (id_mensagem, numero, corpo, dados, estado, dono, criado_em, atualizado_em) VALUES (?, ?, ?, ?, 'recebida', ?, ?, ?)",
+                (ultramsg_data.get("id") or None, numero, msg, json.dumps(ultramsg_data, ensure_ascii=False), os.getpid(), agora, agora),
+            )
+        if not cur.rowcount:
+            self._contar("duplicadas")
+            return None
+        self._contar("registradas")
+        return cur.lastrowid
+
+    def registrar_resposta(self, ids, resposta):
+        # A resposta fica no primeiro registro; os demais fragmentos do grupo ficam como "agrupada".
+        # O primeiro envio já começa com a reserva: a varredura de reenvio só pega a resposta se o
+        # envio não terminar (ex.: o processo caiu) dentro de FILA_LEASE_ENVIO.
+        if not ids:
+            return
+        agora = time.time()
+        with self._conexao() as conn:
+            conn.execute(
+                "UPDATE mensagens SET estado = 'respondida', resposta = ?, proxima_tentativa = ?, atualizado_em = ? WHERE id = ?",
+                (resposta, agora + FILA_LEASE_ENVIO, agora, ids[0]),
+            )
+            conn.executemany(
+                "UPDATE mensagens SET estado = 'agrupada', atualizado_em = ? WHERE id = ?",
+                [(agora, i) for i in ids[1:]],
+            )
+
+    def marcar(self, ids, estado):
+        agora = time.time()
+        with self._conexao() as conn:
+            conn.executemany("UPDATE mensagens SET estado = ?, atualizado_em = ? WHERE id = ?", [(estado, agora, i) for i in ids])
+
+    def resultado_envio(self, id_registro, enviado):
+        agora = time.time()
+        with self._conexao() as conn:
+            if enviado:
+                conn.execute("UPDATE mensagens SET estado = 'enviada', atualizado_em = ? WHERE id = ?", (agora, id_registro))
+                return
+            tentativas = conn.execute("SELECT tentativas FROM mensagens WHERE id = ?", (id_registro,)).fetchone()[0] + 1
+            if tentativas >= FILA_MAX_TENTATIVAS:
+                logging.error(f"❌ Resposta da mensagem {id_registro} não foi entregue após {tentativas} tentativas; desistindo.")
+                conn.execute("UPDATE mensagens SET estado = 'falhou', tentativas = ?, atualizado_em = ? WHERE id = ?", (tentativas, agora, id_registro))
+            else:
+                espera = FILA_BACKOFF_BASE * (2 ** (tentativas - 1)) * random.uniform(0.5, 1.5)
+                conn.execute(
+                    "UPDATE mensagens SET tentativas = ?, proxima_tentativa = ?, atualizado_em = ? WHERE id = ?",
+                    (tentativas, agora + espera, agora, id_registro),
+                )
+        self._contar("falhas_envio")
+
+    def _reservar_reenvios(self):
+        # Reserva (com "lease" de FILA_LEASE_ENVIO) as respostas vencidas, para dois workers não reenviarem a mesma
+        agora = time.time()
+        reservadas = []
+        with self._conexao() as conn:
+            pendentes = conn.execute(
+                "SELECT id, numero, resposta, proxima_tentativa FROM mensagens WHERE estado = 'respondida' AND proxima_tentativa <= ? ORDER BY id LIMIT 50",
+                (agora,),
+            ).fetchall()
+            for id_registro, numero, resposta, prevista in pendentes:
+                cur = conn.execute(
+                    "UPDATE mensagens SET proxima_tentativa = ? WHERE id = ? AND proxima_tentativa = ?",
+                    (agora + FILA_LEASE_ENVIO, id_registro, prevista),
+                )
+                if cur.rowcount:
+                    reservadas.append((id_registro, numero, resposta))
+        return reservadas
+
+    def reenviar_pendentes(self):
+        for id_registro, numero, resposta in self._reservar_reenvios():
+            self._contar("reenvios")
+            logging.info(f"📤 Reenviando resposta pendente {id_registro} para {numero}.")
+            self.resultado_envio(id_registro, enviar_resposta_ultramsg(numero, resposta))
+
+    def limpar_antigas(self):
+        with self._conexao() as conn:
+            conn.execute(
+                "DELETE FROM mensagens WHERE estado IN ('enviada', 'agrupada', 'descartada', 'falhou') AND atualizado_em < ?",
+                (time.time() - FILA_RETENCAO,),
+            )
+
+    def recuperar_interrompidas(self):
+        # Mensagens "recebida" cujo processo dono não existe mais (ou somos nós, após reiniciar com o mesmo pid)
+        with self._conexao() as conn:
+            linhas = conn.execute("SELECT id, numero, corpo, dados, dono FROM mensagens WHERE estado = 'recebida' ORDER BY id").fetchall()
+            recuperadas = []
+            for id_registro, numero, corpo, dados, dono in linhas:
+                if dono != os.getpid() and _processo_vivo(dono):
+                    continue
+                cur = conn.execute("UPDATE mensagens SET dono = ? WHERE id = ? AND dono IS ?", (os.getpid(), id_registro, dono))
+                if cur.rowcount:
+                    recuperadas.append((id_registro, numero, corpo, json.loads(dados)))
+        self._contar("reprocessadas", len(recuperadas))
+        return recuperadas
+
+    def _loop_reenvio(self):
+        ultima_limpeza = 0.0
+        while True:
+            try:
+                self.reenviar_pendentes()
+                if time.monotonic() - ultima_limpeza > 3600:
+                    self.limpar_antigas()
+                    ultima_limpeza = time.monotonic()
+            except sqlite3.Error as e:
+                logging.error(f"❌ Erro na fila persistente ({self.arquivo}): {e}", exc_info=True)
+            time.sleep(FILA_INTERVALO_REENVIO)
+
+    def iniciar(self):
+        for id_registro, numero, corpo, dados in self.recuperar_interrompidas():
+            logging.info(f"♻️ Reprocessando mensagem {id_registro} de {numero} interrompida antes de responder.")
+            despachar_ou_recusar(dados, numero, corpo, [id_registro])
+        threading.Thread(target=self._loop_reenvio, name="fila-reenvio", daemon=True).start()
+
+    def estatisticas(self):
+        with self._lock:
+            dados = dict(self._metricas)
+        try:
+            for estado, total in self._conexao().execute("SELECT estado, COUNT(*) FROM mensagens GROUP BY estado"):
+                dados[f"estado_{estado}"] = total
+        except sqlite3.Error:
+            pass
+        return dados
+
+
+def _processo_vivo(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+fila = FilaPersistente(FILA_ARQUIVO) if FILA_ATIVA else None
+
+
+def _registrar_resposta_fila(jobs, resposta_final):
+    if fila is not None and jobs:
+        fila.registrar_resposta(jobs, resposta_final)
+
+
+def _resultado_envio_fila(jobs, enviado):
+    if fila is not None and jobs:
+        fila.resultado_envio(jobs[0], enviado)
+
+
+# O aviso de fila cheia sai por threads próprias: quem chama (thread do coalescedor, thread do
+# Flask) não espera o POST na UltraMsg justamente quando o sistema está sobrecarregado.
+# Cada número tem no máximo um aviso pendente, o que também limita essa fila.
+_executor_avisos = ThreadPoolExecutor(max_workers=2, thread_name_prefix="aviso-fila-cheia")
+_avisos_pendentes = set()
+_avisos_lock = threading.Lock()
+
+
+def _enviar_aviso_fila_cheia(numero):
+    try:
+        enviar_resposta_ultramsg(numero, MENSAGEM_FILA_CHEIA)
+    finally:
+        with _avisos_lock:
+            _avisos_pendentes.discard(numero)
+
+
+def avisar_fila_cheia(numero):
+    with _avisos_lock:
+        if numero in _avisos_pendentes:
+            return
+        _avisos_pendentes.add(numero)
+    try:
+        _executor_avisos.submit(_enviar_aviso_fila_cheia, numero)
+    except RuntimeError:
+        # Desligando: o interpretador fecha os executores antes do atexit (ex.: coalescedor.encerrar);
+        # não há mais rajada para proteger, então o aviso sai na própria thread
+        _enviar_aviso_fila_cheia(numero)
+
+
+# Entrega a mensagem e, se a fila estiver cheia, aplica a WEBHOOK_POLITICA_EXCESSO
+def despachar_ou_recusar(ultramsg_data, numero, msg, jobs=()):
+    if despachar_mensagem(ultramsg_data, numero, msg, jobs):
+        return True
+    if fila is not None and jobs:
+        fila.marcar(jobs, "descartada")
+    if WEBHOOK_POLITICA_EXCESSO == "responder":
+        logging.warning(f"⚠️ Fila de mensagens cheia; enviando resposta de espera para {numero}.")
+        avisar_fila_cheia(numero)
+    else:
+        logging.warning(f"⚠️ Fila de mensagens cheia; mensagem de {numero} descartada.")
+    return False
+
+
+# --- Agrupamento de mensagens picadas ---
+# No WhatsApp é comum mandar uma pergunta em 3-4 mensagens seguidas. Os fragmentos do mesmo
+# número que chegam dentro da janela viram um único processamento (uma busca, uma ida à IA,
+# uma resposta). Reentregas do mesmo webhook (mesmo id de mensagem) são descartadas.
+COALESCER_JANELA_MS = int(os.environ.get("COALESCER_JANELA_MS", "400")) # 0 desliga o agrupamento
+COALESCER_ESPERA_MAX_MS = int(os.environ.get("COALESCER_ESPERA_MAX_MS", "2000")) # teto de espera desde o 1º fragmento
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", "600")) # segundos lembrando ids de mensagens já recebidas
+
+
+# Pedidos estruturados completos (ex.: "custo da pr11410") não se juntam ao que já está esperando:
+# "custo da pr11410" + "custo da pr11411" viraria uma mensagem só e o segundo pedido se perderia
+INTENCOES_COMPLETAS = {"custo", "preco_venda"}
+
+
+def mensagem_completa(msg):
+    return roteador.classificar(msg).nome in INTENCOES_COMPLETAS
+
+
+class CoalescedorMensagens:
+    def __init__(self, janela_ms, espera_max_ms, dedup_ttl, entregar, completa=None):
+        self.janela = janela_ms / 1000
+        self.espera_max = espera_max_ms / 1000
+        self.dedup_ttl = dedup_ttl
+        self._entregar = entregar
+        self._completa = completa # msg -> True se o fragmento é um pedido completo por si só
+        self._cond = threading.Condition()
+        self._buffers = {} # numero -> {"partes": [...], "jobs": [...], "dados": ultramsg_data, "prazo": t, "limite": t}
+        self._vistos = OrderedDict() # id da mensagem -> expira_em
+        self._parar = False
+        self._metricas = {"fragmentos": 0, "grupos": 0, "duplicadas": 0}
+        self._thread = threading.Thread(target=self._loop, name="coalescedor-mensagens", daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def _duplicada(self, id_mensagem, agora):
+        # Chamado com o lock adquirido
+        while self._vistos and next(iter(self._vistos.values())) < agora:
+            self._vistos.popitem(last=False)
+        if id_mensagem in self._vistos:
+            return True
+        self._vistos[id_mensagem] = agora + self.dedup_ttl
+        return False
+
+    def receber(self, ultramsg_data, numero, msg, job=None):
+        # Retorna False se for reentrega de uma mensagem já recebida. `job` é o id na fila persistente.
+        agora = time.monotonic()
+        id_mensagem = ultramsg_data.get("id")
+        completa = self.janela > 0 and self._completa is not None and self._completa(msg)
+        anterior = None
+        with self._cond:
+            if id_mensagem and self._duplicada(id_mensagem, agora):
+                self._metricas["duplicadas"] += 1
+                return False
+            self._metricas["fragmentos"] += 1
+            if self.janela <= 0:
+                entregar_agora = True
+            else:
+                entregar_agora = False
+                if completa and numero in self._buffers:
+                    # O grupo que estava esperando sai antes (mesma thread: a ordem por número se mantém)
+                    anterior = self._buffers.pop(numero)
+                buffer = self._buffers.get(numero)
+                if buffer is None:
+                    buffer = self._buffers[numero] = {"partes": [], "jobs": [], "limite": agora + self.espera_max}
+                buffer["partes"].append(msg)
+                if job is not None:
+                    buffer["jobs"].append(job)
+                buffer["dados"] = ultramsg_data
+                buffer["prazo"] = min(agora + self.janela, buffer["limite"]) # cada fragmento reinicia a janela
+                self._cond.notify()
+        if anterior is not None:
+            self._despachar(numero, anterior)
+        if entregar_agora:
+            self._metricas_grupo()
+            self._entregar(ultramsg_data, numero, msg, [job] if job is not None else [])
+        return True
+
+    def _metricas_grupo(self):
+        with self._cond:
+            self._metricas["grupos"] += 1
+
+    def _vencidos(self, todos=False):
+        # Chamado com o lock adquirido: tira do buffer os grupos cuja janela fechou
+        agora = time.monotonic()
+        prontos = [numero for numero, b in self._buffers.items() if todos or b["prazo"] <= agora]
+        return [(numero, self._buffers.pop(numero)) for numero in prontos]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._parar:
+                    if self._buffers:
+                        espera = min(b["prazo"] for b in self._buffers.values()) - time.monotonic()
+                        if espera <= 0:
+                            break
+                        self._cond.wait(espera)
+                    else:
+                        self._cond.wait()
+                if self._parar:
+                    return
+                grupos = self._vencidos()
+            for numero, buffer in grupos:
+                self._despachar(numero, buffer)
+
+    def _despachar(self, numero, buffer):
+        msg = " ".join(buffer["partes"])
+        if len(buffer["partes"]) > 1:
+            logging.info(f"🧩 {len(buffer['partes'])} mensagens de {numero} agrupadas: '{msg}'")
+        self._metricas_grupo()
+        self._entregar(buffer["dados"], numero, msg, buffer["jobs"])
+
+    def encerrar(self):
+        # Entrega o que estiver esperando a janela antes de a fila de processamento drenar
+        with self._cond:
+            self._parar = True
+            grupos = self._vencidos(todos=True)
+            self._cond.notify_all()
+        for numero, buffer in grupos:
+            self._despachar(numero, buffer)
+
+    def estatisticas(self):
+        with self._cond:
+            dados = dict(self._metricas)
+            dados["aguardando"] = len(self._buffers)
+        return dados
+
+
+coalescedor = CoalescedorMensagens(COALESCER_JANELA_MS, COALESCER_ESPERA_MAX_MS, DEDUP_TTL, despachar_ou_recusar, mensagem_completa)
+
+
+# --- Inicialização do servidor ---
+# Importar o módulo não inicia nada (benchmarks, testes e o processo mestre do gunicorn com
+# preload). Catálogo, processamento, coalescedor e fila persistente sobem em iniciar_servidor(),
+# chamado pelo __main__ e, em qualquer servidor WSGI (ex.: cada worker do gunicorn), na primeira
+# requisição do processo.
+_servidor_lock = threading.Lock()
+_servidor_iniciado = False
+
+
+def iniciar_servidor():
+    global _servidor_iniciado
+    if _servidor_iniciado:
+        return
+    with _servidor_lock:
+        if _servidor_iniciado:
+            return
+        iniciar_catalogo()
+        if runtime_async is not None:
+            runtime_async.iniciar()
+            atexit.register(runtime_async.encerrar)
+        else:
+            despachante.iniciar()
+            atexit.register(despachante.encerrar)
+        coalescedor.iniciar()
+        atexit.register(coalescedor.encerrar) # registrado depois do processamento: roda antes da drenagem
+        # Recupera as mensagens interrompidas e liga o reenvio (o processamento já está no ar)
+        if fila is not None:
+            fila.iniciar()
+        _servidor_iniciado = True
+        logging.info(f"🚀 Servidor inicializado no processo {os.getpid()}")
+
+
+# --- Métricas no formato Prometheus ---
+# GET /metrics junta as estatísticas que cada componente já mantém (pool do Postgres, catálogo,
+# caches, limitador da busca, fila de processamento, fila persistente, coalescedor) e os
+# histogramas de latência por serviço externo e por etapa.
+def _nome_metrica(*partes):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(("iris",) + partes))
+
+
+def _linhas_histograma(nome, rotulo, histogramas):
+    linhas = [f"# TYPE {nome} histogram"]
+    for chave, histograma in histogramas.items():
+        dados = histograma.estatisticas()
+        for limite, acumulado in dados["baldes"].items():
+            le = "+Inf" if limite == float("inf") else repr(limite)
+            linhas.append(f'{nome}_bucket{{{rotulo}="{chave}",le="{le}"}} {acumulado}')
+        linhas.append(f'{nome}_sum{{{rotulo}="{chave}"}} {dados["soma_s"]}')
+        linhas.append(f'{nome}_count{{{rotulo}="{chave}"}} {dados["total"]}')
+    return linhas
+
+
+def _linhas_componente(componente, estatisticas):
+    linhas = []
+    for chave, valor in estatisticas.items():
+        if isinstance(valor, bool):
+            valor = int(valor)
+        if isinstance(valor, (int, float)):
+            linhas.append(f"{_nome_metrica(componente, chave)} {valor}")
+    return linhas
+
+
+def metricas_prometheus():
+    componentes = {
+        "pg_pool": pg_pool,
+        "catalogo": atualizador_catalogo,
+        "cache_ia": cache_ia,
+        "cache_busca": cache_busca,
+        "limite_busca": limite_busca,
+        "processamento": runtime_async if runtime_async is not None else despachante,
+        "fila": fila,
+        "coalescedor": coalescedor,
+    }
+    linhas = []
+    for componente, objeto in componentes.items():
+        if objeto is None:
+            continue
+        try:
+            linhas.extend(_linhas_componente(componente, objeto.estatisticas()))
+        except Exception as e:
+            logging.warning(f"⚠️ Erro ao coletar métricas de {componente}: {e}")
+    linhas.extend(_linhas_histograma("iris_upstream_latencia_segundos", "upstream", LATENCIAS_UPSTREAM))
+    linhas.extend(_linhas_histograma("iris_etapa_latencia_segundos", "etapa", LATENCIAS_ETAPAS))
+    return "\n".join(linhas) + "\n"
+
+
+@app.before_request
+def _garantir_servidor_iniciado():
+    iniciar_servidor()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return metricas_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
     data = request.json
-    
-    logging.info(f"✨ Payload JSON bruto recebido da UltraMsg: {json.dumps(data, indent=2)}")
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"✨ Payload JSON bruto recebido da UltraMsg: {json.dumps(data, ensure_ascii=False)}")
 
     if not data:
         logging.warning("⚠️ Requisição sem JSON no corpo. Verifique a configuração do webhook na UltraMsg.")
@@ -372,36 +2537,36 @@ def webhook():
     msg = ultramsg_data.get("body", "").strip().lower()
     # CORRIGIDO AQUI: ultramsg_data.get para 'from'
     numero = ultramsg_data.get("from", "").replace("@c.us", "").strip() 
+    # Uma linha curta por webhook; o payload completo só em DEBUG
+    logging.info(f"✨ Webhook: evento={data.get('event_type')} id={ultramsg_data.get('id')} de={numero} tipo={ultramsg_data.get('type')} tamanho={len(msg)}")
 
     if not msg or not numero:
         logging.warning(f"⚠️ Campos 'body' ou 'from' ausentes ou vazios no payload. Body: '{msg}', From: '{numero}'. Verifique o formato do JSON da UltraMsg.")
         return jsonify({"status": "error", "message": "Campos 'body' ou 'from' ausentes ou vazios"}), 200 
 
 
-    # Inicia o processamento em um thread separado
-    thread = threading.Thread(target=processar_mensagem_em_segundo_plano, args=(ultramsg_data, numero, msg))
-    thread.start()
+    # Agrupa fragmentos do mesmo número e depois enfileira o processamento
+    # (pool de workers ou event loop; ordem preservada por número)
+    # Grava na fila persistente antes de responder 200: se o processo cair, a mensagem não se perde
+    job = None
+    if fila is not None:
+        job = fila.registrar(ultramsg_data, numero, msg)
+        if job is None:
+            logging.info(f"🔁 Mensagem {ultramsg_data.get('id')} de {numero} já registrada; reentrega ignorada.")
+            return jsonify({"status": "duplicate", "message": "Mensagem já recebida."}), 200
+
+    if not coalescedor.receber(ultramsg_data, numero, msg, job):
+        logging.info(f"🔁 Mensagem {ultramsg_data.get('id')} de {numero} já recebida; reentrega ignorada.")
+        return jsonify({"status": "duplicate", "message": "Mensagem já recebida."}), 200
 
     # Retorna 200 OK imediatamente para a UltraMsg
     return jsonify({"status": "received", "message": "Mensagem recebida e processamento iniciado em segundo plano."}), 200
 
-def enviar_resposta_ultramsg(numero, body):
-    try:
-        resp = requests.post(
-            "https://api.ultramsg.com/instance126332/messages/chat",
-            data={
-                "token": ULTRAMSG_TOKEN,
-                "to": numero,
-                "body": body
-            },
-            timeout=10
-        )
-        resp.raise_for_status()
-        logging.info(f"✅ Resposta enviada para {numero}. UltraMsg retornou: {resp.text}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"❌ Erro ao enviar resposta via UltraMsg para {numero}: {e}", exc_info=True)
 
 if __name__ == "__main__":
+    # SIGTERM (deploy/restart) encerra via sys.exit para que o atexit drene a fila de mensagens
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    iniciar_servidor()
     port = int(os.environ.get("PORT", 10000))
     logging.info(f"🚀 Servidor iniciado na porta {port}")
     app.run(host="0.0.0.0", port=port)
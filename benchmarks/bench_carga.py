@@ -0,0 +1,507 @@
+# Teste de carga offline do app.py.
+# Sobe o app num subprocesso apontando para servidores falsos locais da OpenRouter, da UltraMsg e
+# da Google Custom Search (cada um com latência e taxa de erro configuráveis) e para um Postgres
+# descartável com uma tabela `produtos` sintética. Depois dispara webhooks com uma mistura de
+# mensagens (custo, preço de venda, busca de fragrância, perguntas gerais) em taxas crescentes.
+#
+# Para cada taxa, mede a latência até a resposta chegar na UltraMsg falsa (p50/p95/p99), a vazão,
+# e o estado do processo do app: threads, sockets abertos, memória (RSS) e números do /metrics.
+#
+# Postgres: com BENCH_PG_HOST definido, usa esse banco (junto com BENCH_PG_PORT, BENCH_PG_USER,
+# BENCH_PG_PASSWORD e BENCH_PG_NAME). Como a tabela `produtos` dele é apagada e recriada, é preciso
+# passar --recriar-tabela; sem a opção o benchmark se recusa a rodar. Senão, se `initdb`/`pg_ctl`
+# estiverem disponíveis (e o usuário não for root), um cluster temporário é criado e apagado no fim.
+#
+# O aviso de fila cheia não conta como resposta: aparece na coluna "sobrec." e fica fora das latências.
+#
+# Uso: python benchmarks/bench_carga.py [--taxas 5,10,20,40] [--duracao 20] [--latencia-ia 0.8] ...
+# Variáveis de ambiente do app (ex.: WEBHOOK_WORKERS, PROCESSAMENTO_MODO) são repassadas ao subprocesso.
+import argparse
+import ast
+import glob
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app.py")
+
+NOTAS = [
+    "maçã verde", "bambu", "baunilha", "lavanda", "alecrim", "sândalo", "talco", "limão siciliano",
+    "laranja", "bergamota", "jasmim", "rosa", "cedro", "patchouli", "âmbar", "almíscar", "coco",
+    "pêssego", "frutas vermelhas", "chá verde", "erva-doce", "canela", "cravo", "gengibre", "menta",
+]
+
+PERGUNTAS_GERAIS = [
+    "qual a diferença entre perfume e colônia",
+    "quem inventou o perfume",
+    "como conservar uma fragrância por mais tempo",
+    "o que é uma nota de fundo",
+    "qual a previsão do tempo em são paulo",
+    "oi iris, tudo bem?",
+]
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentil(valores, p):
+    # Nearest-rank: sem interpolação, para não inventar latências que não aconteceram
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+# --- Servidores falsos dos serviços externos ---
+class ServidorFalso:
+    def __init__(self, nome, latencia, jitter, taxa_erro, responder):
+        self.nome = nome
+        self.latencia = latencia
+        self.jitter = jitter
+        self.taxa_erro = taxa_erro
+        self.responder = responder # (metodo, caminho, query, corpo) -> dict
+        self.chamadas = 0
+        self.erros = 0
+        self._lock = threading.Lock()
+        self.porta = porta_livre()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", self.porta), self._handler())
+        self._httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.porta}/{self.nome}"
+
+    def _handler(self):
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, como os serviços reais
+
+            def _atender(self, metodo):
+                tamanho = int(self.headers.get("Content-Length") or 0)
+                corpo = self.rfile.read(tamanho) if tamanho else b""
+                time.sleep(max(0.0, random.gauss(servidor.latencia, servidor.jitter)))
+                with servidor._lock:
+                    servidor.chamadas += 1
+                    erro = random.random() < servidor.taxa_erro
+                    if erro:
+                        servidor.erros += 1
+                if erro:
+                    status, resposta = random.choice((429, 500, 503)), {"error": "injetado pelo benchmark"}
+                else:
+                    url = urlparse(self.path)
+                    status, resposta = 200, servidor.responder(metodo, url.path, parse_qs(url.query), corpo)
+                dados = json.dumps(resposta).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(dados)))
+                self.end_headers()
+                self.wfile.write(dados)
+
+            def do_GET(self):
+                self._atender("GET")
+
+            def do_POST(self):
+                self._atender("POST")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def iniciar(self):
+        threading.Thread(target=self._httpd.serve_forever, name=f"falso-{self.nome}", daemon=True).start()
+
+    def parar(self):
+        self._httpd.shutdown()
+
+
+def _constante_do_app(nome):
+    # Lida do código-fonte, sem importar o app (que exige as variáveis e dependências do servidor)
+    with open(APP, encoding="utf-8") as f:
+        for no in ast.parse(f.read()).body:
+            if isinstance(no, ast.Assign) and any(getattr(alvo, "id", None) == nome for alvo in no.targets):
+                return ast.literal_eval(no.value)
+    raise LookupError(f"{nome} não encontrada em {APP}")
+
+
+class CaixaRespostas:
+    # Guarda quando cada número recebeu a resposta na UltraMsg falsa. O aviso de fila cheia
+    # (MENSAGEM_FILA_CHEIA) é contado à parte: não é resposta e não entra nas latências.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.aviso_sobrecarga = _constante_do_app("MENSAGEM_FILA_CHEIA")
+        self.recebidas = {}
+        self.sobrecarga = {}
+
+    def ultramsg(self, metodo, caminho, query, corpo):
+        campos = parse_qs(corpo.decode())
+        numero = campos.get("to", [""])[0]
+        destino = self.sobrecarga if campos.get("body", [""])[0] == self.aviso_sobrecarga else self.recebidas
+        with self._cond:
+            destino.setdefault(numero, time.monotonic())
+            self._cond.notify_all()
+        return {"sent": "true", "message": "ok"}
+
+    def aguardar(self, numeros, prazo):
+        limite = time.monotonic() + prazo
+        with self._cond:
+            while not all(n in self.recebidas or n in self.sobrecarga for n in numeros):
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._cond.wait(restante)
+
+
+def resposta_openrouter(metodo, caminho, query, corpo):
+    return {"choices": [{"message": {"role": "assistant", "content": "Olá! ✨ Resposta de benchmark da Iris. 💖"}}]}
+
+
+def resposta_cse(metodo, caminho, query, corpo):
+    consulta = query.get("q", [""])[0]
+    return {"items": [
+        {"title": f"Resultado {i} para {consulta}", "link": f"https://exemplo.com/{i}", "snippet": "Texto de exemplo. " * 8}
+        for i in range(3)
+    ]}
+
+
+# --- Postgres descartável ---
+def _binario_pg(nome):
+    encontrado = shutil.which(nome)
+    if encontrado:
+        return encontrado
+    candidatos = sorted(glob.glob(f"/usr/lib/postgresql/*/bin/{nome}"))
+    return candidatos[-1] if candidatos else None
+
+
+class PostgresDescartavel:
+    def __init__(self, recriar_tabela=False):
+        self.diretorio = None
+        self.pg_ctl = _binario_pg("pg_ctl")
+        initdb = _binario_pg("initdb")
+        if os.environ.get("BENCH_PG_HOST"):
+            # Banco indicado explicitamente tem prioridade sobre o cluster temporário. popular() apaga
+            # a tabela `produtos` dele, então só com confirmação explícita (pode ser um banco de verdade)
+            if not recriar_tabela:
+                raise SystemExit(
+                    f"BENCH_PG_HOST={os.environ['BENCH_PG_HOST']}: o benchmark apaga e recria a tabela `produtos` "
+                    "desse banco. Passe --recriar-tabela para confirmar (use um banco descartável)."
+                )
+            self.config = {
+                "host": os.environ["BENCH_PG_HOST"],
+                "port": os.environ.get("BENCH_PG_PORT", "5432"),
+                "user": os.environ.get("BENCH_PG_USER", "postgres"),
+                "password": os.environ.get("BENCH_PG_PASSWORD", ""),
+                "dbname": os.environ.get("BENCH_PG_NAME", "postgres"),
+            }
+        elif self.pg_ctl and initdb:
+            self.diretorio = tempfile.mkdtemp(prefix="bench_pg_")
+            porta = porta_livre()
+            dados = os.path.join(self.diretorio, "dados")
+            try:
+                subprocess.run([initdb, "-D", dados, "-U", "bench", "--auth=trust", "-E", "UTF8"], check=True, capture_output=True)
+                subprocess.run([
+                    self.pg_ctl, "-D", dados, "-w", "-l", os.path.join(self.diretorio, "postgres.log"),
+                    "-o", f"-p {porta} -k {self.diretorio} -c listen_addresses=127.0.0.1 -c max_connections=200",
+                    "start",
+                ], check=True, capture_output=True)
+            except subprocess.CalledProcessError as e:
+                # Ex.: o initdb se recusa a rodar como root
+                shutil.rmtree(self.diretorio, ignore_errors=True)
+                self.diretorio = None
+                erro = (e.stderr or b"").decode(errors="replace").strip()
+                raise SystemExit(f"Não foi possível criar o Postgres temporário ({erro}); defina BENCH_PG_HOST (e BENCH_PG_*).")
+            self.config = {"host": "127.0.0.1", "port": str(porta), "user": "bench", "password": "bench", "dbname": "postgres"}
+        else:
+            raise SystemExit("Postgres indisponível: defina BENCH_PG_HOST (e BENCH_PG_*) ou instale initdb/pg_ctl.")
+
+    def popular(self, total_produtos, semente):
+        import psycopg2
+
+        aleatorio = random.Random(semente)
+        linhas = []
+        for i in range(total_produtos):
+            notas = aleatorio.sample(NOTAS, aleatorio.randint(1, 3))
+            linhas.append((f"PR{10000 + i}", " ".join(notas).capitalize(), round(aleatorio.uniform(5, 80), 2)))
+        with psycopg2.connect(**self.config) as conn, conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS produtos")
+            cur.execute("""
+                CREATE TABLE produtos (
+                    pro_in_codigo TEXT PRIMARY KEY,
+                    pro_st_descricao TEXT NOT NULL,
+                    re_custo NUMERIC(10, 2),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            cur.executemany("INSERT INTO produtos (pro_in_codigo, pro_st_descricao, re_custo) VALUES (%s, %s, %s)", linhas)
+        conn.close()
+        return linhas
+
+    def parar(self):
+        if self.diretorio:
+            subprocess.run([self.pg_ctl, "-D", os.path.join(self.diretorio, "dados"), "-m", "fast", "stop"], capture_output=True)
+            shutil.rmtree(self.diretorio, ignore_errors=True)
+
+
+# --- Mistura de mensagens ---
+def gerador_mensagens(produtos, pesos, semente):
+    aleatorio = random.Random(semente)
+    codigos = [codigo.lower() for codigo, _, _ in produtos]
+
+    def custo():
+        if aleatorio.random() < 0.2:
+            return f"custo da {', '.join(aleatorio.sample(codigos, 3))}"
+        if aleatorio.random() < 0.2:
+            return f"qual o custo da {aleatorio.choice(NOTAS)}"
+        return f"qual o custo da {aleatorio.choice(codigos)}"
+
+    def preco_venda():
+        markup = aleatorio.choice(["2", "2,5", "3", "3.2"])
+        return f"preço de venda da {aleatorio.choice(codigos)} com o markup {markup}"
+
+    def fragrancia():
+        return f"tem fragrância com {' e '.join(aleatorio.sample(NOTAS, 2))}?"
+
+    def geral():
+        return aleatorio.choice(PERGUNTAS_GERAIS)
+
+    tipos = {"custo": custo, "preco_venda": preco_venda, "fragrancia": fragrancia, "geral": geral}
+    nomes = list(pesos)
+    while True:
+        nome = aleatorio.choices(nomes, weights=[pesos[n] for n in nomes])[0]
+        yield nome, tipos[nome]()
+
+
+# --- Processo do app ---
+def estado_processo(pid):
+    # Lido do /proc (Linux); em outros sistemas os campos ficam vazios
+    estado = {"threads": None, "sockets": None, "rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("Threads:"):
+                    estado["threads"] = int(linha.split()[1])
+                elif linha.startswith("VmRSS:"):
+                    estado["rss_mb"] = int(linha.split()[1]) / 1024
+        estado["sockets"] = sum(
+            1 for fd in os.listdir(f"/proc/{pid}/fd") if os.readlink(f"/proc/{pid}/fd/{fd}").startswith("socket:")
+        )
+    except OSError:
+        pass
+    return estado
+
+
+def ler_metricas(url_app):
+    metricas = {}
+    try:
+        for linha in requests.get(f"{url_app}/metrics", timeout=5).text.splitlines():
+            if linha and not linha.startswith("#") and "{" not in linha:
+                nome, valor = linha.rsplit(" ", 1)
+                metricas[nome] = float(valor)
+    except (requests.RequestException, ValueError):
+        pass
+    return metricas
+
+
+def iniciar_app(porta, falsos, pg, diretorio, log):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(porta),
+        "OPENROUTER_KEY": "benchmark",
+        "ULTRAMSG_TOKEN": "benchmark",
+        "Search_API_KEY": "benchmark",
+        "Search_CX": "benchmark",
+        "OPENROUTER_URL": falsos["openrouter"].url,
+        "ULTRAMSG_URL": falsos["ultramsg"].url,
+        "GOOGLE_CSE_URL": falsos["google_cse"].url,
+        "PG_DB_HOST": pg.config["host"],
+        "PG_DB_PORT": pg.config["port"],
+        "PG_DB_USER": pg.config["user"],
+        "PG_DB_PASSWORD": pg.config["password"] or "benchmark",
+        "PG_DB_NAME": pg.config["dbname"],
+        "PG_SSLMODE": "disable",
+        "FILA_ARQUIVO": os.path.join(diretorio, "fila.sqlite3"),
+        "IA_CACHE_ARQUIVO": os.path.join(diretorio, "cache_ia.sqlite3"),
+    })
+    # A cota da Custom Search limitaria as perguntas gerais logo no começo; o limitador tem benchmark próprio
+    env.setdefault("CSE_COTA_DIARIA", "1000000")
+    env.setdefault("CSE_RAJADA", "1000000")
+    processo = subprocess.Popen([sys.executable, APP], env=env, stdout=log, stderr=subprocess.STDOUT)
+    url_app = f"http://127.0.0.1:{porta}"
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        if processo.poll() is not None:
+            raise SystemExit(f"app.py terminou ao iniciar (código {processo.returncode}); veja {log.name}")
+        try:
+            requests.get(f"{url_app}/metrics", timeout=1)
+            return processo, url_app
+        except requests.RequestException:
+            time.sleep(0.2)
+    processo.terminate()
+    raise SystemExit(f"app.py não respondeu em 30s; veja {log.name}")
+
+
+# --- Carga ---
+def executar_etapa(url_app, caixa, mensagens, taxa, duracao, espera, sequencia):
+    total = int(taxa * duracao)
+    enviadas = {} # numero -> (inicio, tipo)
+    acks = []
+    recusadas = [0]
+    lock = threading.Lock()
+
+    def enviar(numero, tipo, texto):
+        inicio = time.monotonic()
+        payload = {"event_type": "message_received", "data": {
+            "id": f"bench-{numero}", "from": f"{numero}@c.us", "type": "chat", "body": texto,
+        }}
+        try:
+            resp = requests.post(f"{url_app}/webhook", json=payload, timeout=30)
+            ok = resp.status_code == 200 and resp.json().get("status") == "received"
+        except requests.RequestException:
+            ok = False
+        with lock:
+            acks.append(time.monotonic() - inicio)
+            if ok:
+                enviadas[numero] = (inicio, tipo)
+            else:
+                recusadas[0] += 1
+
+    # Carga em malha aberta: o envio segue o relógio, não espera as respostas anteriores
+    inicio_etapa = time.monotonic()
+    with ThreadPoolExecutor(max_workers=128, thread_name_prefix="carga") as executor:
+        for i in range(total):
+            atraso = inicio_etapa + i / taxa - time.monotonic()
+            if atraso > 0:
+                time.sleep(atraso)
+            tipo, texto = next(mensagens)
+            executor.submit(enviar, f"55119{sequencia + i:08d}", tipo, texto)
+    fim_envio = time.monotonic()
+
+    caixa.aguardar(list(enviadas), espera)
+    sobrecarregadas = sum(1 for numero in enviadas if numero in caixa.sobrecarga and numero not in caixa.recebidas)
+    latencias, por_tipo, ultima = [], {}, fim_envio
+    for numero, (inicio, tipo) in enviadas.items():
+        recebida = caixa.recebidas.get(numero)
+        if recebida is not None:
+            latencias.append(recebida - inicio)
+            por_tipo.setdefault(tipo, []).append(recebida - inicio)
+            ultima = max(ultima, recebida)
+    return {
+        "taxa": taxa,
+        "enviadas": total,
+        "aceitas": len(enviadas),
+        "recusadas": recusadas[0],
+        "respondidas": len(latencias),
+        "sobrecarregadas": sobrecarregadas,
+        "vazao": len(latencias) / (ultima - inicio_etapa) if latencias else 0.0,
+        "p50": percentil(latencias, 50),
+        "p95": percentil(latencias, 95),
+        "p99": percentil(latencias, 99),
+        "ack_p99": percentil(acks, 99),
+        "p95_por_tipo": {tipo: percentil(valores, 95) for tipo, valores in por_tipo.items()},
+    }, total
+
+
+def _ms(valor):
+    return f"{valor * 1000:8.0f}" if valor is not None else "       -"
+
+
+def imprimir_resultado(r):
+    print(
+        f"{r['taxa']:7.1f} {r['enviadas']:8d} {r['respondidas']:8d} {r['recusadas']:6d} {r['vazao']:8.1f} "
+        f"{_ms(r['p50'])} {_ms(r['p95'])} {_ms(r['p99'])} {_ms(r['ack_p99'])} "
+        f"{r['threads'] if r['threads'] is not None else '-':>7} {r['sockets'] if r['sockets'] is not None else '-':>7} "
+        f"{r['rss_mb'] if r['rss_mb'] is not None else 0:7.1f} {r['fila_pendentes']:6.0f} {r['sobrecarregadas']:7d} {r['pg_em_uso']:5.0f}"
+    )
+    print("        p95 por tipo (ms): " + ", ".join(f"{t}={_ms(v).strip()}" for t, v in sorted(r["p95_por_tipo"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga offline do app.py")
+    parser.add_argument("--taxas", default="5,10,20,40", help="mensagens/s de cada etapa, em ordem")
+    parser.add_argument("--duracao", type=float, default=20, help="segundos de envio por etapa")
+    parser.add_argument("--espera", type=float, default=60, help="segundos aguardando as respostas após cada etapa")
+    parser.add_argument("--produtos", type=int, default=2000, help="linhas da tabela produtos sintética")
+    parser.add_argument("--mistura", default="custo=4,preco_venda=2,fragrancia=3,geral=1", help="pesos dos tipos de mensagem")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--json", help="grava os resultados neste arquivo")
+    parser.add_argument("--recriar-tabela", action="store_true", help="com BENCH_PG_HOST: confirma apagar e recriar a tabela produtos")
+    for servico, latencia in (("ia", 0.8), ("cse", 0.3), ("ultramsg", 0.05)):
+        parser.add_argument(f"--latencia-{servico}", type=float, default=latencia, help="segundos (média)")
+        parser.add_argument(f"--jitter-{servico}", type=float, default=latencia / 4, help="desvio padrão, em segundos")
+        parser.add_argument(f"--erro-{servico}", type=float, default=0.0, help="fração de respostas 429/5xx")
+    args = parser.parse_args()
+    random.seed(args.semente)
+
+    caixa = CaixaRespostas()
+    falsos = {
+        "openrouter": ServidorFalso("openrouter", args.latencia_ia, args.jitter_ia, args.erro_ia, resposta_openrouter),
+        "ultramsg": ServidorFalso("ultramsg", args.latencia_ultramsg, args.jitter_ultramsg, args.erro_ultramsg, caixa.ultramsg),
+        "google_cse": ServidorFalso("google_cse", args.latencia_cse, args.jitter_cse, args.erro_cse, resposta_cse),
+    }
+    for falso in falsos.values():
+        falso.iniciar()
+
+    diretorio = tempfile.mkdtemp(prefix="bench_carga_")
+    pg = PostgresDescartavel(args.recriar_tabela)
+    processo = None
+    resultados = []
+    try:
+        produtos = pg.popular(args.produtos, args.semente)
+        pesos = {nome: float(peso) for nome, peso in (item.split("=") for item in args.mistura.split(","))}
+        mensagens = gerador_mensagens(produtos, pesos, args.semente)
+        log = open(os.path.join(diretorio, "app.log"), "w")
+        processo, url_app = iniciar_app(porta_livre(), falsos, pg, diretorio, log)
+        print(f"app.py pid {processo.pid}; log em {log.name}")
+        print(f"Repouso: {estado_processo(processo.pid)}")
+        print()
+        print(" msg/s  enviadas respond. recus.  resp/s   p50 ms   p95 ms   p99 ms  ack p99 threads sockets  RSS MB  fila sobrec.  pg")
+
+        sequencia = 0
+        for taxa in (float(t) for t in args.taxas.split(",")):
+            resultado, enviadas = executar_etapa(url_app, caixa, mensagens, taxa, args.duracao, args.espera, sequencia)
+            sequencia += enviadas
+            resultado.update(estado_processo(processo.pid))
+            metricas = ler_metricas(url_app)
+            resultado["fila_pendentes"] = metricas.get("iris_processamento_pendentes", 0)
+            resultado["pg_em_uso"] = metricas.get("iris_pg_pool_em_uso", 0)
+            resultado["cache_ia_taxa_acerto"] = metricas.get("iris_cache_ia_taxa_acerto")
+            resultados.append(resultado)
+            imprimir_resultado(resultado)
+
+        print()
+        for nome, falso in falsos.items():
+            print(f"{nome}: {falso.chamadas} chamadas, {falso.erros} erros injetados")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"parametros": vars(args), "resultados": resultados}, f, indent=2, ensure_ascii=False)
+    finally:
+        if processo is not None:
+            processo.terminate()
+            try:
+                processo.wait(30)
+            except subprocess.TimeoutExpired:
+                processo.kill()
+        for falso in falsos.values():
+            falso.parar()
+        pg.parar()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Microbenchmark do roteador de intenções.
+# Compara o `roteador.classificar` (uma regex combinada, uma passada) com a cadeia antiga de
+# `any(p in msg ...)` + `re.search` sobre um corpus de mensagens reais dos vendedores.
+#
+# Uso: python benchmarks/bench_roteador.py [repeticoes]
+import os
+import re
+import sys
+import timeit
+
+# O app exige as variáveis de ambiente; para o benchmark bastam valores de mentira
+for _var in ["OPENROUTER_KEY", "ULTRAMSG_TOKEN", "Search_API_KEY", "Search_CX", "PG_DB_USER", "PG_DB_PASSWORD", "PG_DB_HOST", "PG_DB_NAME"]:
+    os.environ.setdefault(_var, "benchmark")
+os.environ.setdefault("CATALOGO_ATIVO", "0")
+os.environ.setdefault("FILA_ATIVA", "0") # não abre nem mexe na fila persistente real
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import roteador  # noqa: E402
+
+CORPUS = [
+    "oi iris, tudo bem?",
+    "bom dia",
+    "qual o custo da pr11410",
+    "qual é o custo da pr20001?",
+    "custo da pr11411",
+    "custo da baunilha cremosa",
+    "qual o custo da maçã verde",
+    "preço de venda da pr11410 com o markup 3",
+    "calcule o preço de venda da pr20001 com o markup 2,5",
+    "qual o preço de venda da pr11411 com o markup 3.2",
+    "tem fragrância com maçã e bambu?",
+    "preciso de um produto com cheiro de baunilha",
+    "alguma fragrancia com notas de lavanda e alecrim",
+    "vocês tem algo que contém sândalo?",
+    "tem com cheiro de talco?",
+    "maçã bambu baunilha",
+    "quais os valores da empresa?",
+    "qual a missão da ginger?",
+    "me fala da cultura da empresa",
+    "como faço para cadastrar um cliente novo?",
+    "qual a diferença entre perfume e colônia",
+    "quem inventou o perfume",
+    "qual a previsão do tempo em são paulo",
+    "obrigado!",
+    "me manda a lista de produtos cítricos",
+    "cheiro de roupa limpa",
+    "fragrância amadeirada com fundo doce",
+    "comprei ontem e o cliente amou",
+    "o que combina com notas florais?",
+    "custo da pr",
+]
+
+
+def classificar_antigo(msg):
+    # Reprodução da cadeia sequencial que existia em processar_mensagem_em_segundo_plano
+    if any(p in msg for p in ["valores", "nossos valores", "quais os valores", "cultura da empresa", "missao", "princípios"]):
+        return "valores"
+    match_custo = re.search(r"(?:qual o|qual é o|preço de)?\s*custo da\s+(pr\d+)", msg)
+    match_custo_nome = re.search(r"(?:qual o|qual é o|preço de)?\s*custo da\s+(.+)", msg)
+    if match_custo or (match_custo_nome and not match_custo_nome.group(1).strip().upper().startswith("PR")):
+        return "custo"
+    if re.search(r"(?:qual o|calcule o)?\s*preço de venda da (pr\d+)\s+com o markup\s+(\d+(?:[.,]\d+)?)", msg):
+        return "preco_venda"
+    if any(p in msg for p in ["fragrância", "fragrancia", "produto", "tem com", "contém", "cheiro", "com"]):
+        return "busca_fragrancia"
+    return "pergunta_geral"
+
+
+def medir(funcao, repeticoes):
+    total = timeit.timeit(lambda: [funcao(m) for m in CORPUS], number=repeticoes)
+    return total / (repeticoes * len(CORPUS)) * 1e6 # µs por mensagem
+
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    antigo = medir(classificar_antigo, repeticoes)
+    novo = medir(roteador.classificar, repeticoes)
+    print(f"Corpus: {len(CORPUS)} mensagens x {repeticoes} repetições")
+    print(f"Cadeia antiga:     {antigo:8.2f} µs/mensagem")
+    print(f"Roteador compilado: {novo:8.2f} µs/mensagem ({antigo / novo:.2f}x)")
+    print()
+    print("Mensagens em que a classificação mudou:")
+    for msg in CORPUS:
+        intencao = roteador.classificar(msg)
+        anterior = classificar_antigo(msg)
+        if intencao.nome != anterior:
+            print(f"  {msg!r}: {anterior} -> {intencao.nome} (pontuação {intencao.pontuacao})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Testes da pesquisa web: normalização das consultas (chave do cache_busca) e limite da cota.
+import os
+import sys
+
+for _var in ["OPENROUTER_KEY", "ULTRAMSG_TOKEN", "Search_API_KEY", "Search_CX", "PG_DB_USER", "PG_DB_PASSWORD", "PG_DB_HOST", "PG_DB_NAME"]:
+    os.environ.setdefault(_var, "teste")
+os.environ.setdefault("CATALOGO_ATIVO", "0")
+os.environ.setdefault("FILA_ATIVA", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import BaldeTokens, normalizar_consulta  # noqa: E402
+
+
+def test_variacoes_de_forma_viram_a_mesma_chave():
+    assert normalizar_consulta("Oi Iris, qual a diferença entre perfume e colônia?") == normalizar_consulta("diferença entre perfume colonia")
+
+
+def test_com_e_sem_nao_colidem():
+    assert normalizar_consulta("perfume com álcool") != normalizar_consulta("perfume sem álcool")
+
+
+def test_preposicoes_que_mudam_o_sentido_ficam_na_chave():
+    assert normalizar_consulta("perfume para homem") != normalizar_consulta("perfume por homem")
+    assert normalizar_consulta("lavanda ou alecrim") != normalizar_consulta("lavanda e alecrim")
+
+
+def test_cota_diaria_cabe_nas_horas_ativas():
+    # Um pedido por minuto durante 8 h de atendimento deve aproveitar a cota inteira, e não mais que ela
+    balde = BaldeTokens(100, 10, 8)
+    permitidas = 0
+    for _ in range(8 * 60):
+        balde._atualizado -= 60
+        permitidas += balde.consumir()
+    assert permitidas == 100
@@ -0,0 +1,54 @@
+# Testes do agrupamento de mensagens picadas (CoalescedorMensagens).
+import os
+import sys
+import time
+
+for _var in ["OPENROUTER_KEY", "ULTRAMSG_TOKEN", "Search_API_KEY", "Search_CX", "PG_DB_USER", "PG_DB_PASSWORD", "PG_DB_HOST", "PG_DB_NAME"]:
+    os.environ.setdefault(_var, "teste")
+os.environ.setdefault("CATALOGO_ATIVO", "0")
+os.environ.setdefault("FILA_ATIVA", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def _coalescedor(entregues):
+    coalescedor = app.CoalescedorMensagens(
+        200, 2000, 600, lambda dados, numero, msg, jobs: entregues.append((numero, msg, jobs)), app.mensagem_completa
+    )
+    coalescedor.iniciar()
+    return coalescedor
+
+
+def test_fragmentos_sao_agrupados():
+    entregues = []
+    coalescedor = _coalescedor(entregues)
+    coalescedor.receber({"id": "1"}, "5511", "qual o custo", 1)
+    coalescedor.receber({"id": "2"}, "5511", "da pr11410", 2)
+    coalescedor.encerrar()
+    assert entregues == [("5511", "qual o custo da pr11410", [1, 2])]
+
+
+def test_pedidos_completos_nao_se_juntam():
+    # Regressão: "custo da pr11410" + "custo da pr11411" viravam uma mensagem e o segundo código sumia
+    entregues = []
+    coalescedor = _coalescedor(entregues)
+    coalescedor.receber({"id": "1"}, "5511", "custo da pr11410", 1)
+    coalescedor.receber({"id": "2"}, "5511", "custo da pr11411", 2)
+    coalescedor.receber({"id": "3"}, "5511", "preço de venda da pr11411 com o markup 3", 3)
+    time.sleep(0.4)
+    coalescedor.encerrar()
+    assert entregues == [
+        ("5511", "custo da pr11410", [1]),
+        ("5511", "custo da pr11411", [2]),
+        ("5511", "preço de venda da pr11411 com o markup 3", [3]),
+    ]
+
+
+def test_reentrega_e_descartada():
+    entregues = []
+    coalescedor = _coalescedor(entregues)
+    assert coalescedor.receber({"id": "1"}, "5511", "oi", 1)
+    assert not coalescedor.receber({"id": "1"}, "5511", "oi", 1)
+    coalescedor.encerrar()
+    assert entregues == [("5511", "oi", [1])]
@@ -0,0 +1,61 @@
+# Testes da fila persistente de mensagens (FilaPersistente).
+import os
+import sys
+
+for _var in ["OPENROUTER_KEY", "ULTRAMSG_TOKEN", "Search_API_KEY", "Search_CX", "PG_DB_USER", "PG_DB_PASSWORD", "PG_DB_HOST", "PG_DB_NAME"]:
+    os.environ.setdefault(_var, "teste")
+os.environ.setdefault("CATALOGO_ATIVO", "0")
+os.environ.setdefault("FILA_ATIVA", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def _fila(tmp_path):
+    return app.FilaPersistente(str(tmp_path / "fila.sqlite3"))
+
+
+def _relogio(monkeypatch, instante):
+    monkeypatch.setattr(app.time, "time", lambda: instante)
+
+
+def test_resposta_em_envio_nao_e_reenviada(tmp_path, monkeypatch):
+    # Regressão: a varredura de reenvio (a cada FILA_INTERVALO_REENVIO) pegava respostas cujo
+    # primeiro envio ainda estava em andamento e mandava a mesma resposta de novo
+    fila = _fila(tmp_path)
+    _relogio(monkeypatch, 1000.0)
+    id_registro = fila.registrar({"id": "m1"}, "5511", "custo da pr11410")
+    fila.registrar_resposta([id_registro], "resposta")
+
+    for decorrido in (0, app.FILA_INTERVALO_REENVIO, 2.5, 10):
+        _relogio(monkeypatch, 1000.0 + decorrido)
+        assert fila._reservar_reenvios() == []
+
+    _relogio(monkeypatch, 1012.0)
+    fila.resultado_envio(id_registro, True)
+    _relogio(monkeypatch, 1000.0 + app.FILA_LEASE_ENVIO + 1)
+    assert fila._reservar_reenvios() == []
+    assert fila.estatisticas()["estado_enviada"] == 1
+
+
+def test_resposta_sem_resultado_de_envio_e_reenviada_apos_a_reserva(tmp_path, monkeypatch):
+    # O processo caiu entre gerar a resposta e concluir o envio: a resposta sai depois do lease
+    fila = _fila(tmp_path)
+    _relogio(monkeypatch, 1000.0)
+    id_registro = fila.registrar({"id": "m1"}, "5511", "custo da pr11410")
+    fila.registrar_resposta([id_registro], "resposta")
+
+    _relogio(monkeypatch, 1000.0 + app.FILA_LEASE_ENVIO + 1)
+    assert fila._reservar_reenvios() == [(id_registro, "5511", "resposta")]
+    assert fila._reservar_reenvios() == []
+
+
+def test_falha_de_envio_agenda_reenvio_com_backoff(tmp_path, monkeypatch):
+    fila = _fila(tmp_path)
+    _relogio(monkeypatch, 1000.0)
+    id_registro = fila.registrar({"id": "m1"}, "5511", "oi")
+    fila.registrar_resposta([id_registro], "resposta")
+    fila.resultado_envio(id_registro, False)
+
+    _relogio(monkeypatch, 1000.0 + app.FILA_BACKOFF_BASE * 1.5 + 0.1)
+    assert fila._reservar_reenvios() == [(id_registro, "5511", "resposta")]
@@ -0,0 +1,43 @@
+# Testes do fluxo de mensagens (_fluxo_mensagem) com os passos de E/S simulados.
+import os
+import sys
+
+for _var in ["OPENROUTER_KEY", "ULTRAMSG_TOKEN", "Search_API_KEY", "Search_CX", "PG_DB_USER", "PG_DB_PASSWORD", "PG_DB_HOST", "PG_DB_NAME"]:
+    os.environ.setdefault(_var, "teste")
+os.environ.setdefault("CATALOGO_ATIVO", "0")
+os.environ.setdefault("FILA_ATIVA", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def _passos(msg):
+    # Roda o fluxo registrando os passos pedidos, sem Postgres, Google nem OpenRouter
+    passos = []
+    respostas = {"notas": [], "web": [], "ia": "resposta", "produtos": []}
+    fluxo = app._fluxo_mensagem(msg)
+    try:
+        passo = next(fluxo)
+        while True:
+            passos.append(passo[0])
+            if passo[0] == "paralelo":
+                passos.extend(p[0] for p in passo[1])
+                passo = fluxo.send([respostas[p[0]] for p in passo[1]])
+            else:
+                passo = fluxo.send(respostas[passo[0]])
+    except StopIteration:
+        return passos
+
+
+def test_pergunta_geral_nao_busca_notas():
+    assert _passos("quem inventou o perfume") == ["web", "ia"]
+
+
+def test_com_solto_busca_catalogo_e_web_em_paralelo():
+    assert _passos("algo com bambu") == ["paralelo", "notas", "web", "ia"]
+
+
+def test_busca_por_notas_sem_termo_nao_consulta_o_banco(monkeypatch):
+    monkeypatch.setattr(app, "get_products_from_pg", lambda **kwargs: (_ for _ in ()).throw(AssertionError(kwargs)))
+    assert app.buscar_por_notas([]) == []
+    assert app.buscar_por_notas(["com"]) == []